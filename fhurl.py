@@ -1,18 +1,67 @@
+import os
 import sys
 import json
+import time
+import gc
+import math
+import errno
+import re
+import atexit
+from functools import wraps
+import hashlib
+import threading
+import logging
+from collections import OrderedDict
 from django.http import HttpResponseRedirect, Http404, HttpResponse
+from django.http import StreamingHttpResponse
 from django import VERSION
 if VERSION[0] >= 2:
-    from django.urls import get_mod_func
+    from django.urls import get_mod_func, get_resolver
 else:
-    from django.core.urlresolvers import get_mod_func
+    from django.core.urlresolvers import get_mod_func, get_resolver
 from django.utils.functional import Promise
+try:
+    from django.utils.encoding import force_text
+except ImportError:  # django 4+
+    from django.utils.encoding import force_str as force_text
+from django.utils import translation
+from django.utils.cache import patch_vary_headers
 from django.template import RequestContext
 from django.shortcuts import render
 from datetime import datetime, date
+from decimal import Decimal
 from django.conf import settings
+from django.core import validators
+from django.core.exceptions import ValidationError, ImproperlyConfigured
+from django.core import signing
+from django.core.files.uploadhandler import FileUploadHandler, SkipFile
+from django.core.files.uploadedfile import TemporaryUploadedFile
+from django.views.decorators.csrf import csrf_exempt, csrf_protect
+try:
+    from django.core.cache import caches
+    _get_cache = caches.__getitem__
+except ImportError:  # django < 1.7
+    from django.core.cache import get_cache as _get_cache
+from django.db import transaction, connections, DatabaseError
+from django.db import DEFAULT_DB_ALIAS, router as db_router
 from django import forms
 from smarturls import surl
+from fhurl_router import ReplicaRouter, get_phase, _set_phase
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+try:
+    import fcntl
+except ImportError:  # windows
+    fcntl = None
+
+try:
+    from concurrent.futures import ProcessPoolExecutor
+except ImportError:
+    ProcessPoolExecutor = None
 
 if sys.version_info < (3,):
     try:
@@ -20,12 +69,17 @@ if sys.version_info < (3,):
     except ImportError:
         from django.utils.encoding import force_unicode
     from urllib import quote as urlquote
+    import Queue as queue
 else:
     # In Python 3 force_unicode does not exist for Django 1.5
     force_unicode = lambda text: text
     basestring = str
+    long = int
     from urllib.parse import quote as urlquote
+    import queue
+
 
+logger = logging.getLogger("fhurl")
 
 
 class JSONEncoder(json.JSONEncoder):
@@ -57,19 +111,249 @@ class JSONResponse(HttpResponse):
             )
 
 
+_default = JSONEncoder().default
+
+
+def _plain(o):
+    # converts o to builtin types, same way JSONEncoder would, for codecs that
+    # do not handle subclasses (like django's ErrorList) or Promise etc
+    if o is None or isinstance(o, (basestring, bytes, bool, int, long, float)):
+        return o
+    if isinstance(o, dict):
+        return dict((_plain(k), _plain(v)) for k, v in o.items())
+    if isinstance(o, (list, tuple)):
+        return [_plain(v) for v in o]
+    return _plain(_default(o))
+
+
+# content type -> function encoding data to bytes, JSON is the default
+_codecs = OrderedDict()
+
+
+def register_codec(content_type, encode):
+    """
+    Makes fhurl responses available in content_type, for requests asking for
+    it in Accept header. encode is called with data containing only builtin
+    types, and must return bytes.
+    """
+    _codecs[content_type] = encode
+
+
+if msgpack is not None:
+    for content_type in ("application/msgpack", "application/x-msgpack"):
+        register_codec(
+            content_type, lambda data: msgpack.packb(data, use_bin_type=True)
+        )
+
+
+def _get_codec(request):
+    accepted = []
+    for i, item in enumerate(request.META.get("HTTP_ACCEPT", "").split(",")):
+        parts = item.split(";")
+        q = 1.0
+        for param in parts[1:]:
+            key, _, value = param.strip().partition("=")
+            if key == "q":
+                try:
+                    q = float(value)
+                except ValueError:
+                    q = 0.0
+        accepted.append((-q, i, parts[0].strip()))
+    for q, i, content_type in sorted(accepted):
+        if q == 0 or content_type in ("application/json", "*/*"):
+            return None
+        if content_type in _codecs:
+            return content_type
+
+
+def encoded_response(request, data, status=200):
+    """
+    Returns data as JSONResponse, or in one of the registered codecs if
+    request prefers it.
+    """
+    content_type = _get_codec(request) if _codecs else None
+    if content_type is None:
+        response = JSONResponse(data)
+    else:
+        response = HttpResponse(
+            _codecs[content_type](_plain(data)), content_type=content_type
+        )
+    response.status_code = status
+    if _codecs:
+        response["Vary"] = "Accept"
+    return response
+
+
+_LIMIT_VALIDATORS = (
+    (validators.MaxLengthValidator, "max_length"),
+    (validators.MinLengthValidator, "min_length"),
+    (validators.MaxValueValidator, "max_value"),
+    (validators.MinValueValidator, "min_value"),
+)
+
+
+_PY_ANCHOR = re.compile(r"(?<!\\)((?:\\\\)*)\\([AZ])")
+_PY_ONLY = re.compile(r"\(\?(P|#|[aiLmsux])")
+_PY_FLAGS = re.IGNORECASE | re.MULTILINE | re.DOTALL | re.VERBOSE
+
+
+def _js_regex(regex):
+    # python pattern as a javascript one, or None if it uses python only
+    # syntax. \A and \Z are ^ and $ in javascript, where \Z matches "Z".
+    if regex.flags & _PY_FLAGS:
+        return None
+    pattern = _PY_ANCHOR.sub(
+        lambda m: m.group(1) + ("^" if m.group(2) == "A" else "$"),
+        regex.pattern
+    )
+    if _PY_ONLY.search(pattern):
+        return None
+    return pattern
+
+
+def _choices(choices):
+    result = []
+    for value, label in choices:
+        if isinstance(label, (list, tuple)):
+            # option group
+            result.append([_render(value), _choices(label)])
+        else:
+            result.append([value, _render(label)])
+    return result
+
+
+def get_field_constraints(field):
+    """
+    Returns the declarative constraints of a form field, so clients can
+    validate it locally. Fields can describe their own constraints with
+    .get_constraints() method returning a dict, it is merged into the result.
+    """
+    d = {}
+    for validator in field.validators:
+        for cls, key in _LIMIT_VALIDATORS:
+            if isinstance(validator, cls):
+                value = validator.limit_value
+                if callable(value):
+                    break
+                if isinstance(value, Decimal):
+                    value = float(value)
+                d[key] = value
+                break
+        else:
+            # EmailValidator and URLValidator are RegexValidator in some
+            # django versions, so check them first
+            if isinstance(validator, validators.EmailValidator):
+                d["format"] = "email"
+            elif isinstance(validator, validators.URLValidator):
+                d["format"] = "url"
+            elif isinstance(validator, validators.RegexValidator):
+                if not getattr(validator, "inverse_match", False):
+                    pattern = _js_regex(validator.regex)
+                    if pattern is not None:
+                        d["regex"] = pattern
+    for attr in ("max_digits", "decimal_places"):
+        if getattr(field, attr, None) is not None:
+            d[attr] = getattr(field, attr)
+    if hasattr(field, "choices") and not hasattr(field, "queryset"):
+        # ModelChoiceField choices would hit the database
+        d["choices"] = _choices(field.choices)
+    if hasattr(field, "get_constraints"):
+        d.update(field.get_constraints())
+    return d
+
+
+# (language, text, params, title) -> (text, rendered text)
+_texts = {}
+
+
+def _render(text, params=None, title=False):
+    """
+    Returns text translated to current language, formatted with params, and
+    title cased if asked, from a cache shared by all requests.
+    """
+    if isinstance(text, Promise):
+        # lazy text is translated when hashed, key by identity instead. The
+        # cache keeps text alive so its id is not reused.
+        key = id(text)
+    else:
+        key = text
+    try:
+        key = (
+            translation.get_language(), key,
+            tuple(sorted(params.items())) if params else None, title
+        )
+        entry = _texts.get(key)
+    except TypeError:
+        key, entry = None, None  # params can not be hashed
+    if entry is not None and (
+        entry[0] is text or not isinstance(text, Promise)
+    ):
+        return entry[1]
+    # like ValidationError does, plural messages pick their form by params
+    rendered = force_text(text % params if params else text)
+    if title:
+        rendered = rendered.title()
+    if key is not None:
+        if len(_texts) >= getattr(settings, "FHURL_TEXT_CACHE_SIZE", 10000):
+            _texts.clear()
+        _texts[key] = (text, rendered)
+    return rendered
+
+
+def render_errors(errors):
+    """
+    Returns form.errors as dict of lists of messages, using cached
+    translations of the messages.
+    """
+    if not hasattr(errors, "as_data"):
+        return errors  # django < 1.7
+    return dict(
+        (
+            field, [
+                _render(error.message, error.params)
+                for error in error_list
+            ]
+        ) for field, error_list in errors.as_data().items()
+    )
+
+
+def precompute_texts(languages=None):
+    """
+    Fills the translation cache with labels, help texts and error messages
+    without parameters (like "This field is required.") of forms of all
+    fhurl() routes, for languages, default is LANGUAGE_CODE. Messages with
+    parameters are cached by their parameters, when first rendered.
+    """
+    if languages is None:
+        languages = [settings.LANGUAGE_CODE]
+    _load_urlconf()
+    for language in languages:
+        with translation.override(language):
+            for key, form_cls, kw in _routes:
+                for field in _get_form_cls(form_cls).base_fields.values():
+                    if field.label:
+                        _render(field.label, title=True)
+                    _render(field.help_text)
+                    for message in field.error_messages.values():
+                        text = force_text(message)
+                        if text and "%(" not in text:
+                            _render(message)
+
+
 def get_form_representation(form):
     d = {}
     for field in form.fields:
         value = form.fields[field]
         dd = {}
         if value.label:
-            dd["label"] = value.label.title()
-        dd["help_text"] = value.help_text
+            dd["label"] = _render(value.label, title=True)
+        dd["help_text"] = _render(value.help_text)
         dd["required"] = value.required
         if field in form.initial:
             dd["initial"] = form.initial[field]
         if value.initial:
             dd["initial"] = value.initial
+        dd.update(get_field_constraints(value))
         d[field] = dd
     return d
 
@@ -110,6 +394,696 @@ class RequestForm(forms.Form):
             setattr(obj, k, d(v))
         return obj
 
+    def invalidate_validations(self, field=None, value=None):
+        """
+        Call from .save() when it changes the validate_only answer for this
+        route, eg after creating a user with a given username.
+        """
+        cache = getattr(self, "validation_cache", None)
+        if cache is not None:
+            cache.invalidate(field, value)
+
+
+def _get_form_cls(form_cls):
+    if isinstance(form_cls, basestring):
+        # can take form_cls of the form: "project.app.forms.FormName"
+        mod_name, form_name = get_mod_func(form_cls)
+        form_cls = getattr(__import__(mod_name, {}, {}, ['']), form_name)
+    return form_cls
+
+
+class _Call(object):
+    def __init__(self):
+        self.event = threading.Event()
+        self.value = None
+        self.failed = False
+
+
+class ValidationCache(object):
+    """
+    Cache of validate_only results of a route, with ttl and LRU eviction.
+    Concurrent identical validations are coalesced, only one of them runs
+    and rest wait for its result.
+
+    With by="field" (default) requests validating a single field are keyed
+    by the field name and its normalized value, others by full submitted
+    data. Use by="data" if clean_<field> depends on other fields.
+
+    Results are also keyed by key(request), which by default is the user (or
+    session) and query parameters of request, as clean methods of a
+    RequestForm can depend on them. Pass key returning None if they do not,
+    to share results between users.
+    """
+    IGNORED = ("validate_only", "field", "json", "next")
+
+    def __init__(self, ttl=60, max_size=1000, by="field", key=None):
+        assert by in ("field", "data"), "by must be field or data"
+        self.ttl = ttl
+        self.max_size = max_size
+        self.by = by
+        self.key = key or self.get_context
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()
+        self.calls = {}
+
+    def get_context(self, request):
+        user = getattr(request, "user", None)
+        if user is not None and user.is_authenticated():
+            identity = ("user", user.pk)
+        else:
+            session = getattr(request, "session", None)
+            identity = ("session", getattr(session, "session_key", None))
+        return identity + (tuple(sorted(
+            (k, tuple(request.GET.getlist(k)))
+            for k in request.GET if k not in self.IGNORED
+        )),)
+
+    def get_key(self, request, form_cls, kwargs):
+        if request.FILES or getattr(request, "upload_errors", None):
+            return None
+        prefix = (
+            form_cls.__module__, form_cls.__name__,
+            tuple(sorted(kwargs.items())), translation.get_language(),
+        )
+        context = (self.key(request),)
+        field = request.REQUEST.get("field")
+        if self.by == "field" and field:
+            return prefix + (
+                "field", field, self.normalize(request.REQUEST.getlist(field))
+            ) + context
+        return prefix + ("data", tuple(sorted(
+            (k, self.normalize(request.REQUEST.getlist(k)))
+            for k in request.REQUEST if k not in self.IGNORED
+        ))) + context
+
+    def normalize(self, values):
+        return tuple(v.strip() for v in values)
+
+    def get_or_compute(self, key, compute):
+        with self.lock:
+            if key in self.entries:
+                expires, value = self.entries.pop(key)
+                if expires > time.time():
+                    self.entries[key] = (expires, value)
+                    return value
+            call = self.calls.get(key)
+            leader = call is None
+            if leader:
+                call = self.calls[key] = _Call()
+        if not leader:
+            call.event.wait()
+            if not call.failed:
+                return call.value
+            return compute()
+        try:
+            call.value = compute()
+        except:
+            call.failed = True
+            raise
+        finally:
+            with self.lock:
+                del self.calls[key]
+                if not call.failed:
+                    self.entries[key] = (time.time() + self.ttl, call.value)
+                    while len(self.entries) > self.max_size:
+                        self.entries.popitem(last=False)
+            call.event.set()
+        return call.value
+
+    def invalidate(self, field=None, value=None):
+        """
+        Drops cached results for field (and value, if given), and all results
+        keyed by full data. Drops everything if field is not given.
+        """
+        with self.lock:
+            if field is None:
+                self.entries.clear()
+                return
+            if value is not None:
+                value = self.normalize([value])
+            for key in list(self.entries):
+                if key[4] == "data" or (
+                    key[5] == field and value in (None, key[6])
+                ):
+                    del self.entries[key]
+
+
+def _pool_input(value):
+    # uploaded files can not be pickled, pass their content instead
+    if hasattr(value, "read"):
+        value.seek(0)
+        content = value.read()
+        value.seek(0)
+        return content
+    return value
+
+
+class pooled(object):
+    """
+    Marks a clean_<field> method to be run in a process pool:
+
+        clean_image = fhurl.pooled(resize_image)
+
+    func must be picklable (defined at module level), it is called with the
+    value returned by field.clean() (content, for files) and must return the
+    cleaned value or raise ValidationError, like clean_<field> would.
+    """
+    def __init__(self, func):
+        self.func = func
+
+    def __get__(self, form, cls=None):
+        if form is None:
+            return self
+        name = [
+            n for n in form.fields
+            if getattr(type(form), "clean_%s" % n, None) is self
+        ][0]
+
+        def clean():
+            future = getattr(form, "_pooled_futures", {}).pop(name, None)
+            if future is not None:
+                return future.result()
+            return self.func(_pool_input(form.cleaned_data[name]))
+        return clean
+
+
+_pool = []
+_pool_lock = threading.Lock()
+
+
+def get_pool():
+    """
+    Returns the process pool shared by all routes, with FHURL_POOL_WORKERS
+    processes (default is number of cpus).
+    """
+    if not _pool:
+        with _pool_lock:
+            if not _pool:
+                _pool.append(
+                    ProcessPoolExecutor(
+                        getattr(settings, "FHURL_POOL_WORKERS", None)
+                    )
+                )
+    return _pool[0]
+
+
+def _reuse_clean(field, value=None, error=None):
+    # form.is_valid() calls field.clean() again, answer it with result of
+    # the first call instead of cleaning (eg decoding an image) twice. Form
+    # fields are copies, so this only affects this form.
+    def clean(*args, **kw):
+        del field.clean
+        if error is not None:
+            raise error
+        return value
+    field.clean = clean
+
+
+def _submit_pooled(form, pool=None):
+    """
+    Starts pooled clean_<field> methods of form in the pool, so they run
+    concurrently with each other and rest of the validation. Fields that fail
+    field.clean() are skipped, form.is_valid() reports them as usual.
+    """
+    if pool is False or not form.is_bound:
+        return form
+    futures = {}
+    for name, field in form.fields.items():
+        if not isinstance(
+            getattr(type(form), "clean_%s" % name, None), pooled
+        ):
+            continue
+        if pool is None:
+            if ProcessPoolExecutor is None:
+                return form
+            pool = get_pool()
+        if getattr(field, "disabled", False):
+            value = form.initial.get(name, field.initial)
+        else:
+            value = field.widget.value_from_datadict(
+                form.data, form.files, form.add_prefix(name)
+            )
+        try:
+            if isinstance(field, forms.FileField):
+                value = field.clean(
+                    value, form.initial.get(name, field.initial)
+                )
+            else:
+                value = field.clean(value)
+        except ValidationError as e:
+            _reuse_clean(field, error=e)
+            continue
+        _reuse_clean(field, value)
+        func = getattr(type(form), "clean_%s" % name).func
+        futures[name] = pool.submit(func, _pool_input(value))
+    form._pooled_futures = futures
+    return form
+
+
+class UploadPolicy(object):
+    """
+    Limits of a file field of a route, checked while the upload is being
+    received. Files larger than max_size bytes, or not of content_types, are
+    dropped as soon as detected and the field gets an error. With
+    stream=True file is written to a temporary file as it arrives, and is
+    never held in memory.
+    """
+    def __init__(self, max_size=None, content_types=None, stream=False):
+        self.max_size = max_size
+        self.content_types = content_types
+        self.stream = stream
+
+
+class PolicyUploadHandler(FileUploadHandler):
+    """
+    Upload handler enforcing {field name: UploadPolicy} of a route, "*" is the
+    policy of fields not listed. Errors are kept in request.upload_errors.
+    """
+    def __init__(self, request, uploads):
+        super(PolicyUploadHandler, self).__init__(request)
+        self.uploads = uploads
+        self.policy = None
+        self.skip = False
+        self.stream_file = None
+        request.upload_errors = {}
+
+    def reject(self, message):
+        self.request.upload_errors[self.field_name] = [message]
+        self.skip = True
+        if self.stream_file is not None:
+            self.stream_file.close()
+            self.stream_file = None
+
+    def new_file(self, field_name, file_name, content_type, *args, **kw):
+        super(PolicyUploadHandler, self).new_file(
+            field_name, file_name, content_type, *args, **kw
+        )
+        self.policy = self.uploads.get(field_name, self.uploads.get("*"))
+        self.skip = False
+        self.stream_file = None
+        if self.policy is None:
+            return
+        if (
+            self.policy.content_types is not None
+            and content_type not in self.policy.content_types
+        ):
+            self.reject("File type %s is not allowed." % content_type)
+        elif self.content_length is not None:
+            self.check_size(self.content_length)
+        if self.policy.stream and not self.skip:
+            self.stream_file = TemporaryUploadedFile(
+                file_name, content_type, 0, self.charset
+            )
+
+    def check_size(self, size):
+        if self.policy.max_size is not None and size > self.policy.max_size:
+            self.reject(
+                "File is larger than %d bytes." % self.policy.max_size
+            )
+
+    def receive_data_chunk(self, raw_data, start):
+        # SkipFile is raised here, and not in new_file(), as django then
+        # closes files of all handlers, which should be of this upload
+        if self.skip:
+            raise SkipFile()
+        if self.policy is None:
+            return raw_data
+        self.check_size(start + len(raw_data))
+        if self.skip:
+            raise SkipFile()
+        if self.stream_file is None:
+            return raw_data
+        self.stream_file.write(raw_data)
+
+    def file_complete(self, file_size):
+        if self.skip or self.stream_file is None:
+            return None
+        self.stream_file.seek(0)
+        self.stream_file.size = file_size
+        return self.stream_file
+
+
+def _with_uploads(view):
+    # upload handlers can only be changed before request.POST is read,
+    # which csrf middleware does, so protect the view after adding them
+    protected = csrf_protect(view)
+
+    def wrapper(request, *args, **kw):
+        if hasattr(request, "_files"):
+            # inserting now would silently skip the policy
+            raise ImproperlyConfigured(
+                "request.POST was read before %s, upload policy can not be "
+                "applied" % request.path
+            )
+        request.upload_handlers.insert(
+            0, PolicyUploadHandler(request, kw["uploads"])
+        )
+        return protected(request, *args, **kw)
+    return csrf_exempt(wraps(view)(wrapper))
+
+
+def _clean(form, pool, request):
+    """
+    Validates form, with pooled clean methods running in pool, and adds
+    errors of files rejected by upload policy.
+    """
+    _submit_pooled(form, pool)
+    upload_errors = getattr(request, "upload_errors", None)
+    if upload_errors:
+        for field, messages in upload_errors.items():
+            form.errors[field] = form.error_class(messages)
+            if field in form.cleaned_data:
+                del form.cleaned_data[field]
+    return form
+
+
+def _validate(form, field=None):
+    if form.is_valid():
+        return {"valid": True, "errors": {}}
+    if field is not None:
+        errors = "".join(render_errors(form.errors).get(field, []))
+    else:
+        errors = render_errors(form.errors)
+    return {"errors": errors, "valid": not errors}
+
+
+class DeadlineExceeded(Exception):
+    pass
+
+
+def _is_mariadb(connection):
+    if hasattr(connection, "mysql_is_mariadb"):
+        return connection.mysql_is_mariadb
+    connection.ensure_connection()
+    return "mariadb" in connection.connection.get_server_info().lower()
+
+
+def _timeout_sql(connection, ms):
+    # returns sql setting statement timeout of connection to ms, and sql
+    # resetting it, None if transaction end resets it
+    if connection.vendor == "postgresql":
+        if getattr(connection, "in_atomic_block", False):
+            return "SET LOCAL statement_timeout = %d" % ms, None
+        return (
+            "SET statement_timeout = %d" % ms,
+            "SET statement_timeout = DEFAULT"
+        )
+    if connection.vendor == "mysql":
+        if _is_mariadb(connection):
+            return (
+                "SET SESSION max_statement_time = %.3f" % (ms / 1000.0),
+                "SET SESSION max_statement_time = DEFAULT"
+            )
+        # only limits SELECT statements
+        return (
+            "SET SESSION max_execution_time = %d" % ms,
+            "SET SESSION max_execution_time = DEFAULT"
+        )
+    return None, None
+
+
+def _read_alias():
+    # replica ReplicaRouter sends reads of current phase to, if any
+    for router in db_router.routers:
+        if isinstance(router, ReplicaRouter):
+            return router.db_for_read(None)
+    return None
+
+
+# aliases of databases that refused statement timeouts
+_no_timeouts = set()
+
+
+class Deadline(object):
+    """
+    Time budget of a request, forms get it as self.deadline. Use it as a
+    context manager to run a phase: it raises DeadlineExceeded if budget is
+    over. Database statements of the request are limited to the budget
+    remaining when the first one runs (on postgresql, mariadb and SELECTs of
+    mysql), until .close(). Connections the request does not use are not
+    touched, this needs django 2.0+, or FHURL_DB_TIMEOUTS setting to set the
+    limit eagerly on first phase instead.
+    """
+    def __init__(self, timeout=None, using=None):
+        self.timeout = timeout
+        self.using = using or DEFAULT_DB_ALIAS
+        self.at = None if timeout is None else time.time() + timeout
+        # alias -> sql resetting its statement timeout
+        self.armed = {}
+        # alias -> execute wrapper waiting for first statement
+        self.wrappers = {}
+
+    def remaining(self):
+        if self.at is None:
+            return None
+        return max(self.at - time.time(), 0)
+
+    def expired(self):
+        return self.at is not None and time.time() >= self.at
+
+    def check(self):
+        if self.expired():
+            raise DeadlineExceeded()
+
+    def arm(self, using):
+        # one SET per connection and request, not per phase
+        if using in self.armed or using in _no_timeouts:
+            return
+        self.armed[using] = None
+        connection = connections[using]
+        if hasattr(connection, "execute_wrappers"):
+            self.wrappers[using] = self.get_wrapper(using)
+            connection.execute_wrappers.append(self.wrappers[using])
+        elif getattr(settings, "FHURL_DB_TIMEOUTS", False):
+            self.set_timeout(using)
+
+    def get_wrapper(self, using):
+        def wrapper(execute, sql, params, many, context):
+            # removed first, so statement setting the timeout skips it
+            self.unwrap(using)
+            self.set_timeout(using)
+            return execute(sql, params, many, context)
+        return wrapper
+
+    def unwrap(self, using):
+        wrapper = self.wrappers.pop(using, None)
+        if wrapper is not None:
+            connections[using].execute_wrappers.remove(wrapper)
+
+    def set_timeout(self, using):
+        connection = connections[using]
+        ms = max(int(self.remaining() * 1000), 1)
+        sql, self.armed[using] = _timeout_sql(connection, ms)
+        if sql is None:
+            return
+        try:
+            connection.cursor().execute(sql)
+        except DatabaseError:
+            logger.warning("fhurl: %s does not support timeouts", using)
+            _no_timeouts.add(using)
+            self.armed[using] = None
+
+    def close(self):
+        for using in list(self.wrappers):
+            self.unwrap(using)
+        for using, reset_sql in self.armed.items():
+            if reset_sql:
+                try:
+                    connections[using].cursor().execute(reset_sql)
+                except DatabaseError:
+                    logger.exception("fhurl: can not reset timeout")
+        self.armed.clear()
+
+    def __enter__(self):
+        self.check()
+        if self.at is not None:
+            self.arm(self.using)
+            replica = _read_alias()
+            if replica is not None:
+                self.arm(replica)
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        if (
+            exc_type is not None and issubclass(exc_type, DatabaseError)
+            and self.expired()
+        ):
+            # statement cancelled by the timeout set in __enter__
+            raise DeadlineExceeded()
+
+
+class Throttled(Exception):
+    def __init__(self, status, retry_after):
+        self.status = status
+        self.retry_after = retry_after
+        super(Throttled, self).__init__(status, retry_after)
+
+
+_PERIODS = {"s": 1, "m": 60, "h": 3600, "d": 86400}
+
+
+def _incr(cache, key, timeout):
+    cache.add(key, 0, timeout)
+    try:
+        return cache.incr(key)
+    except ValueError:
+        # expired or evicted between add and incr
+        cache.add(key, 0, timeout)
+        return cache.incr(key)
+
+
+class Limiter(object):
+    """
+    Admission control of a route, checked before any form work. Limits
+    concurrent requests to max_concurrency (waiting up to queue_timeout
+    seconds for a slot, else 503), and request rate to rate, like "100/m",
+    with a token bucket (else 429).
+
+    Limits apply per key: "route" (whole route), "ip", "user" (user id, or
+    ip for anonymous users) or a callable(request) returning the key. With
+    backend, name of a django cache, limits are shared by all processes
+    using that cache, rate is then counted in fixed windows, and each shared
+    concurrency slot is a cache key expiring slot_ttl seconds after it was
+    taken, so slots of crashed workers are not held forever.
+    """
+    def __init__(
+        self, max_concurrency=None, queue_timeout=0, rate=None, key="route",
+        backend=None, name=None, slot_ttl=300
+    ):
+        self.max_concurrency = max_concurrency
+        self.queue_timeout = queue_timeout
+        self.rate, self.period = None, None
+        if rate is not None:
+            count, period = rate.split("/")
+            self.rate, self.period = int(count), _PERIODS[period[0]]
+        self.key = key
+        self.backend = backend
+        self.name = name
+        self.slot_ttl = slot_ttl
+        self.condition = threading.Condition()
+        self.active = {}
+        self.buckets = {}
+        self.prune_at = 1000
+        self.admitted = 0
+        self.rejected_concurrency = 0
+        self.rejected_rate = 0
+
+    def get_key(self, request):
+        if callable(self.key):
+            return self.key(request)
+        if self.key == "route":
+            return ""
+        ip = request.META.get("REMOTE_ADDR", "")
+        if self.key == "user":
+            user = getattr(request, "user", None)
+            if user is not None and user.is_authenticated():
+                return "user:%s" % user.pk
+        return "ip:%s" % ip
+
+    def take_token(self, key):
+        # returns seconds to wait if there is no token
+        now = time.time()
+        if self.backend is not None:
+            cache = _get_cache(self.backend)
+            window = int(now // self.period)
+            cache_key = "fhurl-rate:%s:%s:%d" % (self.name, key, window)
+            if _incr(cache, cache_key, self.period + 1) > self.rate:
+                return (window + 1) * self.period - now
+            return None
+        with self.condition:
+            if len(self.buckets) >= self.prune_at:
+                self.prune(now)
+            tokens, updated = self.buckets.get(key, (self.rate, now))
+            tokens = self.refill(tokens, updated, now)
+            if tokens < 1:
+                self.buckets[key] = (tokens, now)
+                return (1 - tokens) * self.period / self.rate
+            self.buckets[key] = (tokens - 1, now)
+            return None
+
+    def refill(self, tokens, updated, now):
+        return min(
+            self.rate, tokens + (now - updated) * self.rate / self.period
+        )
+
+    def prune(self, now):
+        # a full bucket is same as no bucket, drop them so keys like ips of
+        # clients that went away do not pile up
+        for key, (tokens, updated) in list(self.buckets.items()):
+            if self.refill(tokens, updated, now) >= self.rate:
+                del self.buckets[key]
+        self.prune_at = max(1000, 2 * len(self.buckets))
+
+    def acquire(self, key):
+        """
+        Returns slot to pass to .release(), or None if no slot was free
+        within queue_timeout.
+        """
+        deadline = time.time() + self.queue_timeout
+        if self.backend is not None:
+            cache = _get_cache(self.backend)
+            while True:
+                # one key per slot, so a slot only expires slot_ttl after
+                # it was taken, not while later ones are held
+                for i in range(self.max_concurrency):
+                    slot = "fhurl-slot:%s:%s:%d" % (self.name, key, i)
+                    if cache.add(slot, 1, self.slot_ttl):
+                        return slot
+                if time.time() >= deadline:
+                    return None
+                time.sleep(0.01)
+        with self.condition:
+            while self.active.get(key, 0) >= self.max_concurrency:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    return None
+                self.condition.wait(remaining)
+            self.active[key] = self.active.get(key, 0) + 1
+            return key
+
+    def release(self, slot):
+        if self.backend is not None:
+            _get_cache(self.backend).delete(slot)
+            return
+        with self.condition:
+            self.active[slot] -= 1
+            if not self.active[slot]:
+                del self.active[slot]
+            # waiters of all keys share the condition, notify() could wake
+            # one of another key and leave this key's waiter asleep
+            self.condition.notify_all()
+
+    def enter(self, request):
+        """
+        Admits the request, or raises Throttled. Returns slot to pass to
+        .exit() once request is done.
+        """
+        key = slot = self.get_key(request)
+        if self.rate is not None:
+            retry_after = self.take_token(key)
+            if retry_after is not None:
+                self.rejected_rate += 1
+                raise Throttled(429, retry_after)
+        if self.max_concurrency is not None:
+            slot = self.acquire(key)
+            if slot is None:
+                self.rejected_concurrency += 1
+                raise Throttled(503, max(self.queue_timeout, 1))
+        self.admitted += 1
+        return slot
+
+    def exit(self, slot):
+        if self.max_concurrency is not None:
+            self.release(slot)
+
+    def stats(self):
+        return {
+            "admitted": self.admitted,
+            "rejected_concurrency": self.rejected_concurrency,
+            "rejected_rate": self.rejected_rate,
+            "active": sum(self.active.values()),
+        }
+
 
 class ResponseReady(Exception):
     def __init__(self, response, *args, **kw):
@@ -117,10 +1091,466 @@ class ResponseReady(Exception):
         super(ResponseReady, self).__init__(*args, **kw)
 
 
+class SignedCookieAuth(object):
+    """
+    require_login check that trusts a signed cookie, or "Authorization: Token
+    <token>" header, instead of loading the session and the user. Verified
+    identities are cached in process for ttl seconds. Sets
+    request.fhurl_identity to the signed user id.
+
+    Use .set_cookie(response, user) in the login view to issue the cookie.
+    """
+    def __init__(
+        self, cookie_name="fhurl_auth", salt="fhurl.auth", max_age=86400,
+        ttl=60, max_size=10000
+    ):
+        self.cookie_name = cookie_name
+        self.salt = salt
+        self.max_age = max_age
+        self.ttl = ttl
+        self.max_size = max_size
+        self.lock = threading.Lock()
+        self.identities = OrderedDict()
+
+    def sign(self, user_id):
+        return signing.dumps(user_id, salt=self.salt)
+
+    def set_cookie(self, response, user):
+        response.set_cookie(
+            self.cookie_name, self.sign(user.pk), max_age=self.max_age,
+            httponly=True
+        )
+        return response
+
+    def get_token(self, request):
+        header = request.META.get("HTTP_AUTHORIZATION", "")
+        if header.startswith("Token "):
+            return header[6:].strip()
+        return request.COOKIES.get(self.cookie_name)
+
+    def get_identity(self, request):
+        token = self.get_token(request)
+        if not token:
+            return None
+        with self.lock:
+            if token in self.identities:
+                expires, identity = self.identities.pop(token)
+                if expires > time.time():
+                    self.identities[token] = (expires, identity)
+                    return identity
+        try:
+            identity = signing.loads(
+                token, salt=self.salt, max_age=self.max_age
+            )
+        except signing.BadSignature:
+            return None
+        with self.lock:
+            self.identities[token] = (time.time() + self.ttl, identity)
+            while len(self.identities) > self.max_size:
+                self.identities.popitem(last=False)
+        return identity
+
+    def __call__(self, request):
+        request.fhurl_identity = self.get_identity(request)
+        return request.fhurl_identity is None
+
+
+class FileSink(object):
+    """
+    AccessLog sink appending events to a file, one JSON object per line.
+    """
+    def __init__(self, path):
+        self.path = path
+
+    def __call__(self, events):
+        with open(self.path, "a") as f:
+            for event in events:
+                f.write(json.dumps(event, cls=JSONEncoder) + "\n")
+
+
+_start_lock = threading.Lock()
+
+
+class _Flusher(object):
+    """
+    Calls .flush() every .interval seconds from a daemon thread. Threads do
+    not survive fork, so one is started in every process, on first use.
+    """
+    pid = None
+
+    def start(self):
+        if self.pid == os.getpid():
+            return
+        with _start_lock:
+            if self.pid == os.getpid():
+                return
+            # parent's flushing thread may have held it at fork. Replaced
+            # before pid, so no thread sees new pid with old lock.
+            self.lock = threading.Lock()
+            self.pid = os.getpid()
+            thread = threading.Thread(target=self.run)
+            thread.daemon = True
+            thread.start()
+            atexit.register(self.run_once)
+
+    def run(self):
+        while True:
+            time.sleep(self.interval)
+            self.run_once()
+
+    def run_once(self):
+        try:
+            self.flush()
+        except Exception:
+            logger.exception("fhurl: flush failed")  # try again next time
+
+
+class AccessLog(_Flusher):
+    """
+    Bounded in memory queue of form_handler outcome events, flushed to sink
+    in batches by a background thread. emit() never blocks, events are
+    dropped (and counted in .dropped) when the queue is full. Events of
+    batches the sink fails on are counted in .failed.
+    """
+    def __init__(self, sink, max_size=10000, batch_size=500, interval=1.0):
+        self.sink = sink
+        self.batch_size = batch_size
+        self.interval = interval
+        self.queue = queue.Queue(max_size)
+        self.dropped = 0
+        self.failed = 0
+        self.lock = threading.Lock()
+
+    def emit(self, event):
+        self.start()
+        try:
+            self.queue.put_nowait(event)
+        except queue.Full:
+            self.dropped += 1
+
+    def flush(self):
+        with self.lock:
+            while True:
+                events = []
+                try:
+                    while len(events) < self.batch_size:
+                        events.append(self.queue.get_nowait())
+                except queue.Empty:
+                    pass
+                if events:
+                    try:
+                        self.sink(events)
+                    except Exception:
+                        # batch is off the queue already, it is lost
+                        self.failed += len(events)
+                        logger.exception(
+                            "fhurl: lost %d access log events", len(events)
+                        )
+                        return
+                if len(events) < self.batch_size:
+                    return
+
+
+_access_log = []
+
+
+def get_access_log():
+    """
+    Returns the AccessLog set with set_access_log(), or one writing to
+    FHURL_ACCESS_LOG file, or None if access log is not enabled.
+    """
+    if not _access_log:
+        path = getattr(settings, "FHURL_ACCESS_LOG", None)
+        _access_log.append(AccessLog(FileSink(path)) if path else None)
+    return _access_log[0]
+
+
+def set_access_log(log):
+    del _access_log[:]
+    _access_log.append(log)
+
+
+def _escape(value):
+    return ("%s" % value).replace("\\", "\\\\").replace(
+        '"', '\\"'
+    ).replace("\n", "\\n")
+
+
+_METRICS_FILE = re.compile(r"^fhurl-(\d+)-\d+\.json$")
+
+
+def _alive(pid):
+    try:
+        os.kill(pid, 0)
+    except OSError as e:
+        return e.errno != errno.ESRCH
+    return True
+
+
+class Metrics(_Flusher):
+    """
+    In process registry of per route counters and histograms, updated by
+    form_handler. With directory, every process writes its values to a file
+    in it every interval seconds, and collect() adds up all the files, so
+    prefork servers report totals of all workers.
+    """
+    LATENCY_BUCKETS = (
+        0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10
+    )
+    SIZE_BUCKETS = (100, 1000, 10000, 100000, 1000000)
+    path_pid = None
+
+    def __init__(self, directory=None, interval=5.0):
+        self.directory = directory
+        self.interval = interval
+        self.lock = threading.Lock()
+        self.counters = {}
+        self.histograms = {}
+
+    def _inc(self, name, labels, value=1):
+        key = (name, labels)
+        self.counters[key] = self.counters.get(key, 0) + value
+
+    def _observe(self, name, labels, value, buckets):
+        key = (name, labels)
+        if key not in self.histograms:
+            self.histograms[key] = [buckets, [0] * len(buckets), 0, 0]
+        h = self.histograms[key]
+        for i, le in enumerate(buckets):
+            if value <= le:
+                h[1][i] += 1
+        h[2] += value
+        h[3] += 1
+
+    def record(self, event, size=None):
+        if self.directory:
+            self.start()
+        route = (("route", event["route"]),)
+        with self.lock:
+            self._inc(
+                "fhurl_requests_total", route + (
+                    ("outcome", event["outcome"]),
+                )
+            )
+            for field in event["errors"]:
+                self._inc(
+                    "fhurl_validation_failures_total",
+                    route + (("field", field),)
+                )
+            if event["outcome"] == "error" and event["saved"]:
+                self._inc("fhurl_save_exceptions_total", route)
+            self._observe(
+                "fhurl_latency_seconds", route, event["latency"],
+                self.LATENCY_BUCKETS
+            )
+            if size is not None:
+                self._observe(
+                    "fhurl_response_bytes", route, size, self.SIZE_BUCKETS
+                )
+
+    def snapshot(self):
+        with self.lock:
+            return {
+                "counters": [
+                    [name, labels, value]
+                    for (name, labels), value in self.counters.items()
+                ],
+                "histograms": [
+                    [name, labels, list(buckets), list(counts), total, count]
+                    for (name, labels), (buckets, counts, total, count)
+                    in self.histograms.items()
+                ],
+            }
+
+    def flush(self):
+        if not self.directory:
+            return
+        if self.path_pid != os.getpid():
+            # pids get reused, a new worker must not overwrite totals of a
+            # dead one, so name includes start time of the process
+            self.path_pid = os.getpid()
+            self.path = os.path.join(
+                self.directory,
+                "fhurl-%d-%d.json" % (self.path_pid, time.time() * 1000)
+            )
+        path = self.path
+        with open(path + ".tmp", "w") as f:
+            json.dump(self.snapshot(), f)
+        os.rename(path + ".tmp", path)
+
+    def collect(self):
+        """
+        Returns (counters, histograms) of this process, or of all processes
+        if directory is set. Files of processes that exited are then merged
+        into one, so directory does not grow with every worker restart.
+        """
+        if not self.directory:
+            return self.add_up([self.snapshot()])
+        self.flush()
+        if fcntl is None:
+            return self.add_up(self.read_files())
+        with open(os.path.join(self.directory, ".lock"), "w") as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            self.merge_exited()
+            return self.add_up(self.read_files())
+
+    def read_files(self, names=None):
+        snapshots = []
+        for name in names or os.listdir(self.directory):
+            if name.startswith("fhurl-") and name.endswith(".json"):
+                with open(os.path.join(self.directory, name)) as f:
+                    snapshots.append(json.load(f))
+        return snapshots
+
+    def merge_exited(self):
+        exited = []
+        for name in os.listdir(self.directory):
+            match = _METRICS_FILE.match(name)
+            if match and not _alive(int(match.group(1))):
+                exited.append(name)
+        if not exited:
+            return
+        names = exited[:]
+        if os.path.exists(os.path.join(self.directory, "fhurl-totals.json")):
+            names.append("fhurl-totals.json")
+        counters, histograms = self.add_up(self.read_files(names))
+        path = os.path.join(self.directory, "fhurl-totals.json")
+        with open(path + ".tmp", "w") as f:
+            json.dump({
+                "counters": [
+                    [name, labels, value]
+                    for (name, labels), value in counters.items()
+                ],
+                "histograms": [
+                    [name, labels, buckets, counts, total, count]
+                    for (name, labels), (buckets, counts, total, count)
+                    in histograms.items()
+                ],
+            }, f)
+        os.rename(path + ".tmp", path)
+        for name in exited:
+            os.remove(os.path.join(self.directory, name))
+
+    def add_up(self, snapshots):
+        counters, histograms = {}, {}
+        for snapshot in snapshots:
+            for name, labels, value in snapshot["counters"]:
+                key = (name, tuple(tuple(label) for label in labels))
+                counters[key] = counters.get(key, 0) + value
+            for name, labels, buckets, counts, total, count in (
+                snapshot["histograms"]
+            ):
+                key = (name, tuple(tuple(label) for label in labels))
+                if key not in histograms:
+                    histograms[key] = [buckets, [0] * len(buckets), 0, 0]
+                h = histograms[key]
+                h[1] = [a + b for a, b in zip(h[1], counts)]
+                h[2] += total
+                h[3] += count
+        return counters, histograms
+
+    def exposition(self):
+        """
+        Returns collected metrics in prometheus text format.
+        """
+        def fmt(name, labels, value):
+            if labels:
+                name += "{%s}" % ",".join(
+                    '%s="%s"' % (k, _escape(v)) for k, v in labels
+                )
+            return "%s %s" % (name, value)
+
+        counters, histograms = self.collect()
+        lines, seen = [], set()
+        for (name, labels), value in sorted(counters.items()):
+            if name not in seen:
+                seen.add(name)
+                lines.append("# TYPE %s counter" % name)
+            lines.append(fmt(name, labels, value))
+        for (name, labels), (buckets, counts, total, count) in sorted(
+            histograms.items()
+        ):
+            if name not in seen:
+                seen.add(name)
+                lines.append("# TYPE %s histogram" % name)
+            for le, n in zip(buckets, counts):
+                lines.append(fmt(name + "_bucket", labels + (("le", le),), n))
+            lines.append(
+                fmt(name + "_bucket", labels + (("le", "+Inf"),), count)
+            )
+            lines.append(fmt(name + "_sum", labels, total))
+            lines.append(fmt(name + "_count", labels, count))
+        return "\n".join(lines) + "\n"
+
+
+_metrics = []
+
+
+def get_metrics():
+    """
+    Returns the Metrics set with set_metrics(), or one created if
+    FHURL_METRICS setting is true (using FHURL_METRICS_DIR directory, if
+    set), or None if metrics are not enabled.
+    """
+    if not _metrics:
+        metrics = None
+        if getattr(settings, "FHURL_METRICS", False):
+            metrics = Metrics(getattr(settings, "FHURL_METRICS_DIR", None))
+        _metrics.append(metrics)
+    return _metrics[0]
+
+
+def set_metrics(metrics):
+    del _metrics[:]
+    _metrics.append(metrics)
+
+
+def metrics_handler(request):
+    """
+    View returning metrics in prometheus text format, only to addresses in
+    FHURL_METRICS_ALLOWED_IPS, no one by default: behind a local proxy every
+    request comes from localhost.
+    """
+    allowed = getattr(settings, "FHURL_METRICS_ALLOWED_IPS", ())
+    if request.META.get("REMOTE_ADDR") not in allowed:
+        return HttpResponse(status=403)
+    metrics = get_metrics()
+    if metrics is None:
+        raise Http404("metrics are not enabled")
+    return HttpResponse(
+        metrics.exposition(), content_type="text/plain; version=0.0.4"
+    )
+
+
+def _note(request, **kw):
+    event = getattr(request, "fhurl_event", None)
+    if event is not None:
+        event.update(kw)
+
+
+def _login_redirect(request, require_login, login_url, is_ajax):
+    if login_url is None:
+        login_url = getattr(settings, "LOGIN_URL", "/login/")
+    if callable(require_login):
+        require_login = require_login(request)
+    elif require_login:
+        require_login = not request.user.is_authenticated()
+    if require_login:
+        redirect_url = "%s?next=%s" % (
+            login_url, urlquote(request.get_full_path())
+        )  # FIXME
+        if is_ajax:
+            return encoded_response(
+                request, {'success': False, 'redirect': redirect_url}
+            )
+        return HttpResponseRedirect(redirect_url)
+
+
 def _form_handler(
     request, form_cls, require_login=False, block_get=False, ajax=False,
     next=None, template=None, login_url=None, pass_request=True,
-    validate_only=False, **kwargs
+    validate_only=False, validation_cache=None, timeout=None, pool=None,
+    route=None, uploads=None, limiter=None, replicas=True, **kwargs
 ):
     """
     Some ajax heavy apps require a lot of views that are merely a wrapper
@@ -132,55 +1562,84 @@ def _form_handler(
     if "next" in request.REQUEST:
         next = request.REQUEST["next"]
     is_ajax = request.is_ajax() or ajax or request.REQUEST.get("json") == "true"
-    if isinstance(form_cls, basestring):
-        # can take form_cls of the form: "project.app.forms.FormName"
-        mod_name, form_name = get_mod_func(form_cls)
-        form_cls = getattr(__import__(mod_name, {}, {}, ['']), form_name)
+    form_cls = _get_form_cls(form_cls)
     validate_only = (
         validate_only or request.REQUEST.get("validate_only") == "true"
     )
-    if login_url is None:
-        login_url = getattr(settings, "LOGIN_URL", "/login/")
-    if callable(require_login):
-        require_login = require_login(request)
-    elif require_login:
-        require_login = not request.user.is_authenticated()
-    if require_login:
-        redirect_url = "%s?next=%s" % (
-            login_url, urlquote(request.get_full_path())
-        )  # FIXME
-        if is_ajax:
-            return JSONResponse({'success': False, 'redirect': redirect_url})
-        return HttpResponseRedirect(redirect_url)
+    response = _login_redirect(request, require_login, login_url, is_ajax)
+    if response:
+        _note(request, outcome="login")
+        return response
     if block_get and request.method != "POST":
         raise Http404("only post allowed")
     if next:
         assert template, "template required when next provided"
+    deadline = request.fhurl_deadline = Deadline(timeout)
 
     def get_form(with_data=False):
         _form = form_cls(request) if pass_request else form_cls()
         _form.next = next
+        _form.validation_cache = validation_cache
+        _form.deadline = deadline
         if with_data:
             _form.data = request.REQUEST
             _form.files = request.FILES
             _form.is_bound = True
         if hasattr(_form, "init"):
-            res = _form.init(**kwargs)
+            with deadline:
+                res = _form.init(**kwargs)
             if res:
                 raise ResponseReady(res)
         return _form
 
+    if replicas:
+        _set_phase("schema" if request.method == "GET" else "validation")
     if is_ajax and request.method == "GET":
-        return JSONResponse(get_form_representation(get_form()))
+        _note(request, outcome="schema")
+        return encoded_response(
+            request, get_form_representation(get_form())
+        )
     if template and request.method == "GET":
+        _note(request, outcome="form")
         return render(request, template, {"form": get_form()})
     form = get_form(with_data=True)
-    if form.is_valid():
-        if validate_only:
-            return JSONResponse({"valid": True, "errors": {}})
-        r = form.save()
+    if validate_only:
+        field = request.REQUEST.get("field")
+        key = None
+        if validation_cache is not None:
+            key = validation_cache.get_key(request, form_cls, kwargs)
+        with deadline:
+            if key is None:
+                result = _validate(_clean(form, pool, request), field)
+            else:
+                result = validation_cache.get_or_compute(
+                    key, lambda: _plain(
+                        _validate(_clean(form, pool, request), field)
+                    )
+                )
+        if field is not None:
+            failed = [field] if result["errors"] else []
+        else:
+            failed = sorted(result["errors"])
+        _note(
+            request, outcome="valid" if result["valid"] else "invalid",
+            errors=failed
+        )
+        return encoded_response(request, result)
+    with deadline:
+        valid = _clean(form, pool, request).is_valid()
+    if not valid:
+        _note(request, outcome="invalid", errors=sorted(form.errors))
+    if valid:
+        _note(request, saved=True)
+        if replicas:
+            _set_phase("save")
+        with deadline:
+            r = form.save()
+        _note(request, outcome="saved")
         if is_ajax:
-            return JSONResponse(
+            return encoded_response(
+                request,
                 {
                     'success': True,
                     RESULT_KEY: (
@@ -194,7 +1653,8 @@ def _form_handler(
             return HttpResponseRedirect(next)
         if template:
             return HttpResponseRedirect(r)
-        return JSONResponse(
+        return encoded_response(
+            request,
             {
                 'success': True,
                 RESULT_KEY: (
@@ -202,32 +1662,506 @@ def _form_handler(
                 )
             }
         )
-    if validate_only:
-        if "field" in request.REQUEST:
-            errors = form.errors.get(request.REQUEST["field"], "")
-            if errors:
-                errors = "".join(errors)
-        else:
-            errors = form.errors
-        return JSONResponse({"errors": errors, "valid": not errors})
     if is_ajax:
-        return JSONResponse({'success': False, 'errors': form.errors})
+        return encoded_response(
+            request,
+            {'success': False, 'errors': render_errors(form.errors)}
+        )
     if template:
         return render(request, template, {"form": form})
-    return JSONResponse({'success': False, 'errors': form.errors})
+    return encoded_response(
+        request, {'success': False, 'errors': render_errors(form.errors)}
+    )
+
+
+def _route_of(request, form_cls):
+    # key of form_handler used directly as a view, not through fhurl()
+    match = getattr(request, "resolver_match", None)
+    if match is not None and match.url_name:
+        return match.url_name
+    if isinstance(form_cls, basestring):
+        return form_cls
+    return "%s.%s" % (form_cls.__module__, form_cls.__name__)
 
 
-def form_handler(*args, **kw):
+def form_handler(request, *args, **kw):
+    log, metrics = get_access_log(), get_metrics()
+    if log is not None or metrics is not None:
+        start = time.time()
+        route = kw.get("route") or _route_of(
+            request, kw["form_cls"] if "form_cls" in kw else args[0]
+        )
+        request.fhurl_event = {
+            "route": route, "method": request.method,
+            "outcome": "error", "errors": [], "saved": False, "time": start,
+        }
+    response, limiter, limit_key = None, kw.get("limiter"), None
     try:
-        return _form_handler(*args, **kw)
+        if limiter is not None:
+            limit_key = limiter.enter(request)
+        response = _form_handler(request, *args, **kw)
+    except ResponseReady as e:
+        _note(request, outcome="response")
+        response = e.response
+    except DeadlineExceeded:
+        _note(request, outcome="timeout")
+        response = encoded_response(
+            request, {'success': False, 'timeout': True}, status=504
+        )
+    except Throttled as e:
+        _note(request, outcome="throttled")
+        response = encoded_response(
+            request, {'success': False, 'throttled': True}, status=e.status
+        )
+        response["Retry-After"] = "%d" % math.ceil(e.retry_after)
+    finally:
+        _set_phase(None)
+        if hasattr(request, "fhurl_deadline"):
+            request.fhurl_deadline.close()
+        if limit_key is not None:
+            limiter.exit(limit_key)
+        if log is not None or metrics is not None:
+            event = request.fhurl_event
+            event["latency"] = time.time() - start
+            event["status"] = (
+                response.status_code if response is not None else 500
+            )
+            if log is not None:
+                log.emit(event)
+            if metrics is not None:
+                size = None
+                if response is not None and not response.streaming:
+                    size = len(response.content)
+                metrics.record(event, size)
+    return response
+
+
+def _get_payloads(request, prefix, max_num):
+    if request.META.get("CONTENT_TYPE", "").startswith("application/json"):
+        payloads = json.loads(request.body.decode("utf-8"))
+        if not isinstance(payloads, list):
+            raise ValueError("expected a list of form payloads")
+        if len(payloads) > max_num:
+            raise ValueError("at most %d forms allowed" % max_num)
+        return [(payload, None) for payload in payloads]
+    # sent by client, check it before building anything of that size
+    total = int(request.REQUEST.get("%s-TOTAL_FORMS" % prefix, 0))
+    if total > max_num:
+        raise ValueError("at most %d forms allowed" % max_num)
+    return [
+        (request.REQUEST, "%s-%d" % (prefix, i)) for i in range(total)
+    ]
+
+
+def _atomic():
+    if hasattr(transaction, "atomic"):
+        return transaction.atomic()
+    return transaction.commit_on_success()
+
+
+def _save_all(form_cls, form_list):
+    with _atomic():
+        if hasattr(form_cls, "save_all"):
+            results = form_cls.save_all(form_list)
+        else:
+            results = [form.save() for form in form_list]
+    if results is None:
+        results = [None] * len(form_list)
+    return results
+
+
+def _formset_handler(
+    request, form_cls, require_login=False, login_url=None,
+    pass_request=True, validate_only=False, prefix="form", max_num=1000,
+    **kwargs
+):
+    """
+    Like form_handler, but binds a list of forms, either from a JSON list of
+    form payloads or from django formset style POST data, and saves all of
+    them in one transaction, with form_cls.save_all(forms) if available.
+    """
+    RESULT_KEY = getattr(settings, "RESULT_KEY", "response")
+    request.REQUEST = request.GET.copy()
+    request.REQUEST.update(request.POST)
+    form_cls = _get_form_cls(form_cls)
+    validate_only = (
+        validate_only or request.REQUEST.get("validate_only") == "true"
+    )
+    response = _login_redirect(request, require_login, login_url, True)
+    if response:
+        return response
+
+    def get_form(data=None, prefix=None):
+        kw = {"prefix": prefix}
+        _form = form_cls(request, **kw) if pass_request else form_cls(**kw)
+        if data is not None:
+            _form.data = data
+            _form.files = request.FILES
+            _form.is_bound = True
+        if hasattr(_form, "init"):
+            res = _form.init(**kwargs)
+            if res:
+                raise ResponseReady(res)
+        return _form
+
+    if request.method == "GET":
+        return encoded_response(
+            request, get_form_representation(get_form())
+        )
+    try:
+        payloads = _get_payloads(request, prefix, max_num)
+    except ValueError as e:
+        return encoded_response(
+            request, {'success': False, 'errors': [str(e)]}
+        )
+    form_list = [get_form(data, prefix) for data, prefix in payloads]
+    valid = all([form.is_valid() for form in form_list])
+    errors = [render_errors(form.errors) for form in form_list]
+    if validate_only:
+        return encoded_response(
+            request, {"valid": valid, "errors": errors}
+        )
+    if not valid:
+        return encoded_response(
+            request, {'success': False, 'errors': errors}
+        )
+    results = _save_all(form_cls, form_list)
+    return encoded_response(
+        request,
+        {
+            'success': True,
+            RESULT_KEY: [
+                form.get_json(r) if hasattr(form, "get_json") else r
+                for form, r in zip(form_list, results)
+            ]
+        }
+    )
+
+
+def formset_handler(*args, **kw):
+    try:
+        return _formset_handler(*args, **kw)
+    except ResponseReady as e:
+        return e.response
+
+
+def _read_lines(request, max_line_size):
+    while True:
+        line = request.readline(max_line_size + 1)
+        if not line:
+            return
+        if len(line) > max_line_size and not line.endswith(b"\n"):
+            # skip rest of the line, without holding it in memory
+            while line and not line.endswith(b"\n"):
+                line = request.readline(max_line_size)
+            yield None
+            continue
+        yield line
+
+
+_missing = object()
+
+
+def _ingest(request, get_form, form_cls, chunk_size, max_line_size):
+    RESULT_KEY = getattr(settings, "RESULT_KEY", "response")
+    counts = {"valid": 0, "invalid": 0}
+    pending, form_list = [], []
+    # reason import stopped before end of body, if it did
+    stopped = []
+
+    def flush():
+        results, missing = [], "no result"
+        if form_list:
+            try:
+                results = list(_save_all(form_cls, form_list))
+            except Exception:
+                # chunk is rolled back, its lines are reported as not saved
+                logger.exception("fhurl: can not save ingested lines")
+                missing = "could not save"
+                stopped.append(missing)
+            else:
+                if len(results) < len(form_list):
+                    logger.error(
+                        "fhurl: save_all returned %d results for %d forms",
+                        len(results), len(form_list)
+                    )
+        results = iter(results)
+        for lineno, form, errors in pending:
+            if form is not None:
+                r = next(results, _missing)
+                if r is _missing:
+                    form, errors = None, {"__all__": [missing]}
+                    counts["valid"] -= 1
+                    counts["invalid"] += 1
+            if form is None:
+                d = {"line": lineno, "success": False, "errors": errors}
+            else:
+                d = {
+                    "line": lineno, "success": True,
+                    RESULT_KEY: (
+                        form.get_json(r) if hasattr(form, "get_json") else r
+                    )
+                }
+            yield json.dumps(d, cls=JSONEncoder) + "\n"
+        del pending[:]
+        del form_list[:]
+
+    for lineno, line in enumerate(_read_lines(request, max_line_size), 1):
+        if line is not None and not line.strip():
+            continue
+        try:
+            if line is None:
+                raise ValueError("line too long")
+            payload = json.loads(line.decode("utf-8"))
+            if not isinstance(payload, dict):
+                raise ValueError("expected a form payload")
+            form = get_form(payload)
+        except ValueError as e:
+            pending.append((lineno, None, {"__all__": [str(e)]}))
+            counts["invalid"] += 1
+        except ResponseReady as e:
+            # .init() refused this line, rest are not read
+            reason = "refused with status %d" % e.response.status_code
+            pending.append((lineno, None, {"__all__": [reason]}))
+            counts["invalid"] += 1
+            stopped.append(reason)
+        else:
+            if form.is_valid():
+                pending.append((lineno, form, None))
+                form_list.append(form)
+                counts["valid"] += 1
+            else:
+                pending.append((lineno, None, render_errors(form.errors)))
+                counts["invalid"] += 1
+        if len(pending) >= chunk_size or stopped:
+            for chunk in flush():
+                yield chunk
+        if stopped:
+            break
+    for chunk in flush():
+        yield chunk
+    summary = dict(counts, done=not stopped)
+    if stopped:
+        summary["error"] = stopped[0]
+    yield json.dumps(summary) + "\n"
+
+
+def _ingest_handler(
+    request, form_cls, require_login=False, login_url=None,
+    pass_request=True, chunk_size=500, max_line_size=1024 * 1024, **kwargs
+):
+    """
+    Reads newline delimited JSON form payloads from request body, one at a
+    time, validates each with form_cls, and saves valid ones chunk_size at a
+    time, with form_cls.save_all(forms) if available. Result of each line is
+    streamed back as newline delimited JSON, so memory used does not depend
+    on size of the upload.
+    """
+    # like other handlers, but without POST: body is the stream of payloads
+    request.REQUEST = request.GET.copy()
+    form_cls = _get_form_cls(form_cls)
+    response = _login_redirect(request, require_login, login_url, True)
+    if response:
+        return response
+
+    def get_form(data=None):
+        _form = form_cls(request) if pass_request else form_cls()
+        if data is not None:
+            _form.data = data
+            _form.is_bound = True
+        if hasattr(_form, "init"):
+            res = _form.init(**kwargs)
+            if res:
+                raise ResponseReady(res)
+        return _form
+
+    # .init() can refuse the request, call it before streaming starts
+    form = get_form()
+    if request.method == "GET":
+        return encoded_response(request, get_form_representation(form))
+    return StreamingHttpResponse(
+        _ingest(request, get_form, form_cls, chunk_size, max_line_size),
+        content_type="application/x-ndjson"
+    )
+
+
+def ingest_handler(*args, **kw):
+    try:
+        return _ingest_handler(*args, **kw)
     except ResponseReady as e:
         return e.response
 
 
+# list of (key, form_cls, kw) for every fhurl() route, in urls.py order
+_routes = []
+
+
 def fhurl(reg, form_cls, decorator=lambda x: x, **kw):
     name = kw.pop("name", None)
     kw["form_cls"] = form_cls
-    return surl(reg, decorator(form_handler), kw, name=name)
+    kw["route"] = name or reg
+    if kw.get("validation_cache") is True:
+        kw["validation_cache"] = ValidationCache()
+    if "max_concurrency" in kw or "rate" in kw:
+        kw["limiter"] = Limiter(
+            kw.pop("max_concurrency", None), kw.pop("queue_timeout", 0),
+            kw.pop("rate", None), kw.pop("limit_by", "route")
+        )
+    if kw.get("limiter") is not None and kw["limiter"].name is None:
+        kw["limiter"].name = name or reg
+    _routes.append((name or reg, form_cls, kw))
+    view = form_handler
+    if kw.get("uploads"):
+        view = _with_uploads(view)
+    return surl(reg, decorator(view), kw, name=name)
+
+
+def fhurl_formset(reg, form_cls, decorator=lambda x: x, **kw):
+    name = kw.pop("name", None)
+    kw["form_cls"] = form_cls
+    _routes.append((name or reg, form_cls, kw))
+    return surl(reg, decorator(formset_handler), kw, name=name)
+
+
+def fhurl_ingest(reg, form_cls, decorator=lambda x: x, **kw):
+    name = kw.pop("name", None)
+    kw["form_cls"] = form_cls
+    _routes.append((name or reg, form_cls, kw))
+    return surl(reg, decorator(ingest_handler), kw, name=name)
+
+
+def _load_urlconf():
+    # routes are only registered once urls.py is imported
+    __import__(settings.ROOT_URLCONF, {}, {}, [''])
+
+
+# (language, private) -> manifest of all routes
+_manifest = {}
+_manifest_lock = threading.Lock()
+
+
+def _build_manifest(private):
+    forms = {}
+    for key, form_cls, kw in _routes:
+        if kw.get("require_login") and not private:
+            # per route GET would redirect anonymous users to login
+            continue
+        try:
+            form_cls = _get_form_cls(form_cls)
+            if kw.get("pass_request", True):
+                form = form_cls(None)
+            else:
+                form = form_cls()
+            forms[key] = get_form_representation(form)
+        except Exception:
+            # eg form needing a real request, clients can still GET its route
+            logger.exception("fhurl: can not add %s to manifest", key)
+    return forms
+
+
+def _versioned(forms, language):
+    content = json.dumps([language, forms], cls=JSONEncoder, sort_keys=True)
+    return {
+        "version": hashlib.sha1(content.encode("utf-8")).hexdigest(),
+        "forms": forms,
+    }
+
+
+def get_manifest(names=None, private=False):
+    """
+    Returns the representation of every fhurl() route (or of routes in
+    `names`) as one document, in current language. Route key is the url name
+    if given, else the url regex. Routes with require_login are only included
+    if private is true. Built once per language on first use, call
+    reset_manifest() to rebuild.
+    """
+    key = (translation.get_language(), private)
+    language = key[0]
+    if key not in _manifest:
+        with _manifest_lock:
+            if key not in _manifest:
+                _load_urlconf()
+                _manifest[key] = _versioned(
+                    _build_manifest(private), language
+                )
+    manifest = _manifest[key]
+    if names is None:
+        return manifest
+    # not cached, names come from clients
+    return _versioned(
+        dict((k, v) for k, v in manifest["forms"].items() if k in names),
+        language
+    )
+
+
+def reset_manifest():
+    _manifest.clear()
+
+
+def manifest_handler(request, names=None, max_age=None, private=False):
+    """
+    View returning get_manifest() as JSON, with ETag and Cache-Control. Routes
+    can be filtered with `names` or with ?names=a,b request parameter. Pass
+    private=True to include routes with require_login, and protect the view.
+    """
+    if "names" in request.GET:
+        names = request.GET["names"].split(",")
+    manifest = get_manifest(names, private)
+    etag = manifest["version"]
+    content_type = _get_codec(request)
+    if content_type:
+        etag += "-" + content_type.split("/")[-1]
+    etag = '"%s"' % etag
+    if max_age is None:
+        max_age = getattr(settings, "FHURL_MANIFEST_MAX_AGE", 86400)
+    if request.META.get("HTTP_IF_NONE_MATCH") == etag:
+        response = HttpResponse(status=304)
+        if _codecs:
+            response["Vary"] = "Accept"
+    else:
+        response = encoded_response(request, manifest)
+        response["Content-Language"] = translation.get_language()
+    # labels are translated, so is the manifest
+    patch_vary_headers(response, ["Accept-Language"])
+    response["ETag"] = etag
+    response["Cache-Control"] = "%smax-age=%d" % (
+        "private, " if private else "", max_age
+    )
+    return response
+
+
+def preload(languages=None, freeze=True):
+    """
+    Prepares fhurl state in prefork server master, before workers are
+    forked: imports form classes of all routes, fills the url resolver, and
+    builds the manifest and the translation cache, for languages (default is
+    LANGUAGE_CODE). With freeze, garbage collection is disabled first, and
+    all objects are then moved to permanent generation with gc.freeze()
+    (python 3.7+), so workers share them copy-on-write instead of each
+    building and dirtying its own copy. Collection is enabled again in
+    forked workers.
+    """
+    freeze = freeze and hasattr(gc, "freeze")
+    if freeze:
+        # a collection now would only dirty pages we want to share
+        gc.disable()
+        os.register_at_fork(after_in_child=gc.enable)
+    if languages is None:
+        languages = [settings.LANGUAGE_CODE]
+    _load_urlconf()
+    for i, (key, form_cls, kw) in enumerate(_routes):
+        # kw is the url pattern's kwargs, so requests get the class too
+        kw["form_cls"] = form_cls = _get_form_cls(form_cls)
+        _routes[i] = (key, form_cls, kw)
+    resolver = get_resolver(None)
+    for language in languages:
+        with translation.override(language):
+            # compiles url patterns, resolver keeps them per language
+            resolver.reverse_dict
+            get_manifest()
+    precompute_texts(languages)
+    if freeze:
+        gc.freeze()
 
 
 def try_del(d, *args):
@@ -0,0 +1,63 @@
+"""
+Database router of fhurl, in its own module so DATABASE_ROUTERS can load it
+while django.db is still being imported (django < 1.7), which fhurl itself
+imports.
+"""
+import random
+import threading
+from django.conf import settings
+
+# django.db.DEFAULT_DB_ALIAS, django.db can not be imported here
+DEFAULT_DB_ALIAS = "default"
+_READ_PHASES = ("schema", "validation")
+
+_state = threading.local()
+
+
+def get_phase():
+    """
+    Returns phase of the fhurl request being handled in this thread:
+    "schema", "validation" (including .init()), "save" or None.
+    """
+    return getattr(_state, "phase", None)
+
+
+def _set_phase(phase):
+    _state.phase = phase
+    if phase is None:
+        _state.replica = None
+
+
+class ReplicaRouter(object):
+    """
+    Database router sending reads of "schema" and "validation" phases of
+    fhurl requests to a database of FHURL_REPLICAS setting, picked at random
+    once per request, and everything else to default database. A write in
+    any phase pins rest of the request to default database.
+    """
+    def get_replicas(self):
+        return getattr(settings, "FHURL_REPLICAS", [])
+
+    def db_for_read(self, model, **hints):
+        replicas = self.get_replicas()
+        if replicas and get_phase() in _READ_PHASES:
+            if getattr(_state, "replica", None) is None:
+                _state.replica = random.choice(replicas)
+            return _state.replica
+        return None
+
+    def db_for_write(self, model, **hints):
+        if get_phase() is not None:
+            _set_phase("save")
+            return DEFAULT_DB_ALIAS
+        instance = hints.get("instance")
+        if instance is not None and instance._state.db in self.get_replicas():
+            # else django would write to database instance was read from
+            return DEFAULT_DB_ALIAS
+        return None
+
+    def allow_relation(self, obj1, obj2, **hints):
+        dbs = set(self.get_replicas() + [DEFAULT_DB_ALIAS])
+        if obj1._state.db in dbs and obj2._state.db in dbs:
+            return True
+        return None
@@ -0,0 +1,4 @@
+from django.db import models
+
+class Book(models.Model):
+    title = models.CharField(max_length=50)
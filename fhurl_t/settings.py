@@ -7,7 +7,13 @@ DATABASES = {
         'ENGINE': DATABASE_ENGINE,
         'NAME': DATABASE_NAME,
     },
+    'replica': {
+        'ENGINE': DATABASE_ENGINE,
+        'NAME': '/tmp/fhurl-replica.db',
+    },
 }
+DATABASE_ROUTERS = ['fhurl_router.ReplicaRouter']
+FHURL_REPLICAS = ['replica']
 ROOT_URLCONF = 'fhurl_t.urls'
 
 INSTALLED_APPS = ['fhurl_t']
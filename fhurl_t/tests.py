@@ -1,5 +1,26 @@
+import os
 import json
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import unittest
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from django.core.files.uploadedfile import SimpleUploadedFile
 from django.test import TestCase
+from django.utils import translation
+import fhurl
+from fhurl import ValidationCache, register_codec
+from fhurl import AccessLog, FileSink, set_access_log
+from fhurl import Metrics, set_metrics
+from fhurl import render_errors, precompute_texts
+from fhurl import Limiter, Throttled, preload
+from fhurl_t.urls import ConstrainedForm, AjaxOnly
+from fhurl_t.models import Book
+from fhurl_t.urls import UsernameForm, CountingField, auth
 
 
 LOGIN_WITH_URL = '/login/with/'
@@ -201,3 +222,986 @@ class TestFhurl(TestCase):
         self.assertTrue(data['valid'])
         self.assertEqual(data['errors'], {})
 
+
+    # manifest
+    def test_manifest(self):
+        response = self.client.get('/manifest/')
+        self.assertEqual(response.status_code, 200)
+        data = json.loads(response.content.decode())
+        self.assertEqual(response['ETag'], '"%s"' % data['version'])
+        form = data['forms']['^login/with/$']
+        self.assertEqual(form['username']['label'], 'Username')
+        self.assertTrue(form['password']['required'])
+        self.assertIn('named', data['forms'])
+
+    def test_manifest_not_modified(self):
+        etag = self.client.get('/manifest/')['ETag']
+        response = self.client.get('/manifest/', HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 304)
+
+    def test_manifest_names(self):
+        response = self.client.get('/manifest/?names=named')
+        data = json.loads(response.content.decode())
+        self.assertEqual(list(data['forms'].keys()), ['named'])
+        self.assertNotEqual(
+            response['ETag'], self.client.get('/manifest/')['ETag']
+        )
+
+    def test_manifest_names_not_cached(self):
+        fhurl.reset_manifest()
+        for i in range(5):
+            self.client.get('/manifest/?names=named,%d' % i)
+        self.assertEqual(len(fhurl._manifest), 1)
+
+    def test_manifest_language(self):
+        response = self.client.get('/manifest/')
+        self.assertIn('Accept-Language', response['Vary'])
+        with translation.override('de'):
+            manifest = fhurl.get_manifest()
+        self.assertNotEqual(manifest['version'], fhurl.get_manifest()['version'])
+
+    def test_manifest_private(self):
+        response = self.client.get('/manifest/')
+        forms = json.loads(response.content.decode())['forms']
+        self.assertNotIn('^login/required/$', forms)
+        self.assertIn(
+            '^login/required/$', fhurl.get_manifest(private=True)['forms']
+        )
+
+    def test_manifest_skips_broken_form(self):
+        forms = fhurl.get_manifest()['forms']
+        self.assertNotIn('^user/$', forms)
+        self.assertIn('named', forms)
+
+    def test_representation_constraints(self):
+        response = self.client.get('/constraints/')
+        data = json.loads(response.content.decode())
+        self.assertEqual(data['email']['format'], 'email')
+        self.assertEqual(data['age']['min_value'], 18)
+        self.assertEqual(data['age']['max_value'], 99)
+        self.assertEqual(data['code']['regex'], '^[A-Z]{3}$')
+        self.assertEqual(data['code']['min_length'], 3)
+        self.assertEqual(
+            data['color']['choices'], [['r', 'Red'], ['g', 'Green']]
+        )
+        self.assertEqual(data['price']['max_digits'], 5)
+        self.assertEqual(data['price']['decimal_places'], 2)
+        self.assertEqual(data['price']['max_value'], 100)
+        self.assertEqual(data['even']['multiple_of'], 2)
+        self.assertEqual(
+            data['shade']['choices'], [['d', 'Dark'], ['l', 'Light']]
+        )
+        self.assertTrue(data['slug']['regex'].endswith('+$'))
+        self.assertNotIn('regex', data['word'])
+        self.assertEqual(data['even']['required'], True)
+
+    def test_representation_max_length(self):
+        response = self.client.get('/login/with/?json=true')
+        data = json.loads(response.content.decode())
+        self.assertEqual(data['username']['max_length'], 100)
+
+    # validation cache
+    def validate_username(self, username):
+        response = self.client.post(
+            '/cached/validation/?validate_only=true&field=username',
+            {'username': username}
+        )
+        return json.loads(response.content.decode())
+
+    def test_validation_cache(self):
+        del UsernameForm.checks[:]
+        self.assertFalse(self.validate_username('amitu')['valid'])
+        data = self.validate_username(' amitu ')
+        self.assertFalse(data['valid'])
+        self.assertEqual(data['errors'], 'This username is already taken.')
+        self.assertEqual(UsernameForm.checks, ['amitu'])
+        self.assertTrue(self.validate_username('newf')['valid'])
+        self.assertEqual(UsernameForm.checks, ['amitu', 'newf'])
+
+    def test_validation_cache_invalidate(self):
+        self.assertTrue(self.validate_username('jack')['valid'])
+        self.client.post('/cached/validation/', {'username': 'jack'})
+        self.assertFalse(self.validate_username('jack')['valid'])
+
+    def test_validation_cache_context(self):
+        url = '/cached/me/?validate_only=true&field=username&me=%s'
+        response = self.client.post(url % 'a', {'username': 'a'})
+        self.assertTrue(json.loads(response.content.decode())['valid'])
+        response = self.client.post(url % 'b', {'username': 'a'})
+        self.assertFalse(json.loads(response.content.decode())['valid'])
+
+    def test_validation_cache_shared(self):
+        del UsernameForm.checks[:]
+        url = '/cached/shared/?validate_only=true&field=username&x=%s'
+        for x in 'ab':
+            self.client.post(url % x, {'username': 'shared'})
+        self.assertEqual(UsernameForm.checks, ['shared'])
+
+    def test_validation_cache_single_flight(self):
+        cache = ValidationCache()
+        started, release = threading.Event(), threading.Event()
+        calls, results = [], []
+
+        def compute():
+            calls.append(1)
+            started.set()
+            release.wait()
+            return {'valid': True}
+
+        def validate():
+            results.append(cache.get_or_compute('key', compute))
+
+        threads = [threading.Thread(target=validate) for i in range(5)]
+        threads[0].start()
+        started.wait()
+        for thread in threads[1:]:
+            thread.start()
+        release.set()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(results, [{'valid': True}] * 5)
+
+    def test_validation_cache_lru(self):
+        cache = ValidationCache(max_size=2)
+        for key in 'abc':
+            cache.get_or_compute(key, lambda: key)
+        self.assertEqual(list(cache.entries), ['b', 'c'])
+
+    # formsets
+    def post_books(self, books, url='/books/'):
+        response = self.client.post(
+            url, json.dumps(books), content_type='application/json'
+        )
+        self.assertEqual(response.status_code, 200)
+        return json.loads(response.content.decode())
+
+    def test_formset_json(self):
+        data = self.post_books([{'title': 'one'}, {'title': 'two'}])
+        self.assertTrue(data['success'])
+        self.assertEqual(data['response'], ['one', 'two'])
+        self.assertEqual(
+            sorted(Book.objects.values_list('title', flat=True)),
+            ['one', 'two']
+        )
+
+    def test_formset_errors(self):
+        data = self.post_books([{'title': 'one'}, {}])
+        self.assertFalse(data['success'])
+        self.assertEqual(data['errors'][0], {})
+        self.assertIn('title', data['errors'][1])
+        self.assertEqual(Book.objects.count(), 0)
+
+    def test_formset_validate_only(self):
+        data = self.post_books([{}], url='/books/?validate_only=true')
+        self.assertFalse(data['valid'])
+        self.assertIn('title', data['errors'][0])
+
+    def test_formset_max_num(self):
+        data = self.post_books([{'title': 'x'}] * 4)
+        self.assertFalse(data['success'])
+        self.assertEqual(Book.objects.count(), 0)
+
+    def test_formset_management_form(self):
+        params = {
+            'form-TOTAL_FORMS': '2',
+            'form-0-username': 'formset1',
+            'form-1-username': 'formset2',
+        }
+        response = self.client.post('/users/', params)
+        data = json.loads(response.content.decode())
+        self.assertTrue(data['success'])
+        self.assertEqual(data['response'], ['formset1', 'formset2'])
+
+    def test_formset_huge_total_forms(self):
+        params = {'form-TOTAL_FORMS': '20000000', 'form-0-title': 'x'}
+        response = self.client.post('/books/', params)
+        data = json.loads(response.content.decode())
+        self.assertEqual(
+            data, {'success': False, 'errors': ['at most 3 forms allowed']}
+        )
+
+    def test_formset_get(self):
+        data = json.loads(self.client.get('/books/').content.decode())
+        self.assertEqual(data['title']['max_length'], 50)
+
+    # ingest
+    def test_ingest(self):
+        body = "\n".join([
+            '{"title": "one"}', '{}', 'not json', '',
+            '{"title": "%s"}' % ('x' * 100), '{"title": "two"}',
+            '{"title": "three"}',
+        ])
+        response = self.client.post(
+            '/books/import/', body, content_type='application/x-ndjson'
+        )
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response['Content-Type'], 'application/x-ndjson')
+        lines = [
+            json.loads(line) for line in
+            b''.join(response.streaming_content).decode().splitlines()
+        ]
+        self.assertEqual([line.get('line') for line in lines[:-1]],
+                         [1, 2, 3, 5, 6, 7])
+        self.assertEqual(lines[0]['response'], 'one')
+        self.assertIn('title', lines[1]['errors'])
+        self.assertFalse(lines[2]['success'])
+        self.assertEqual(lines[3]['errors'], {'__all__': ['line too long']})
+        self.assertEqual(lines[5]['response'], 'three')
+        self.assertEqual(
+            lines[-1], {'done': True, 'valid': 3, 'invalid': 3}
+        )
+        self.assertEqual(
+            sorted(Book.objects.values_list('title', flat=True)),
+            ['one', 'three', 'two']
+        )
+
+    def ingest(self, titles, url='/books/import/picky/'):
+        body = "\n".join('{"title": "%s"}' % title for title in titles)
+        response = self.client.post(
+            url, body, content_type='application/x-ndjson'
+        )
+        return [
+            json.loads(line) for line in
+            b''.join(response.streaming_content).decode().splitlines()
+        ]
+
+    def test_ingest_refused(self):
+        lines = self.ingest(['one', 'stop', 'two'])
+        self.assertEqual([line.get('line') for line in lines[:-1]], [1, 2])
+        self.assertTrue(lines[0]['success'])
+        self.assertEqual(
+            lines[1]['errors'], {'__all__': ['refused with status 403']}
+        )
+        self.assertFalse(lines[-1]['done'])
+        self.assertEqual(lines[-1]['error'], 'refused with status 403')
+        self.assertEqual(
+            list(Book.objects.values_list('title', flat=True)), ['one']
+        )
+
+    def test_ingest_short_results(self):
+        lines = self.ingest(['one', 'short', 'two'])
+        self.assertEqual(
+            [line.get('success') for line in lines[:-1]], [True, False, True]
+        )
+        self.assertEqual(lines[1]['errors'], {'__all__': ['no result']})
+        self.assertEqual(
+            lines[-1], {'done': True, 'valid': 2, 'invalid': 1}
+        )
+
+    def test_ingest_custom_requirement(self):
+        lines = self.ingest(['one'], '/books/import/custom/?foo=bar')
+        self.assertTrue(lines[0]['success'])
+        response = self.client.post(
+            '/books/import/custom/', '{"title": "one"}',
+            content_type='application/x-ndjson'
+        )
+        self.assertIn('redirect', json.loads(response.content.decode()))
+
+    def test_ingest_save_failed(self):
+        lines = self.ingest(['one', 'two', 'boom', 'three', 'four'])
+        self.assertEqual(
+            [line.get('success') for line in lines[:-1]],
+            [True, True, False, False]
+        )
+        self.assertEqual(lines[3]['errors'], {'__all__': ['could not save']})
+        self.assertEqual(lines[-1], {
+            'done': False, 'error': 'could not save', 'valid': 2,
+            'invalid': 2,
+        })
+        self.assertEqual(
+            sorted(Book.objects.values_list('title', flat=True)),
+            ['one', 'two']
+        )
+
+    # codecs
+    def test_json_is_default(self):
+        response = self.client.get(
+            '/login/with/?json=true', HTTP_ACCEPT='text/html, */*'
+        )
+        self.assertEqual(response['Content-Type'], 'application/json')
+
+    def test_custom_codec(self):
+        register_codec('text/x-keys', lambda d: ','.join(sorted(d)).encode())
+        try:
+            response = self.client.post(
+                '/login/with/?json=true',
+                HTTP_ACCEPT='application/json;q=0.5, text/x-keys'
+            )
+            self.assertEqual(response['Content-Type'], 'text/x-keys')
+            self.assertEqual(response.content, b'errors,success')
+            self.assertEqual(response['Vary'], 'Accept')
+        finally:
+            del fhurl._codecs['text/x-keys']
+
+    @unittest.skipIf(fhurl.msgpack is None, "msgpack is not installed")
+    def test_msgpack(self):
+        response = self.client.post(
+            '/both/ajax/and/web/?validate_only=true',
+            HTTP_ACCEPT='application/msgpack'
+        )
+        self.assertEqual(response['Content-Type'], 'application/msgpack')
+        data = fhurl.msgpack.unpackb(response.content, raw=False)
+        self.assertFalse(data['valid'])
+        self.assertEqual(
+            data['errors']['username'], ['This field is required.']
+        )
+
+    # deadlines
+    def test_deadline_exceeded(self):
+        params = {'username': 'john', 'password': 'asd'}
+        response = self.client.post('/slow/init/', params)
+        self.assertEqual(response.status_code, 504)
+        data = json.loads(response.content.decode())
+        self.assertEqual(data, {'success': False, 'timeout': True})
+
+    def test_deadline_remaining(self):
+        params = {'username': 'john', 'password': 'asd'}
+        response = self.client.post('/deadline/', params)
+        data = json.loads(response.content.decode())
+        self.assertTrue(data['success'])
+        self.assertTrue(0 < data['response'] <= 10)
+
+    def test_deadline_sets_timeout_once(self):
+        executed = []
+
+        class Cursor(object):
+            def execute(self, sql):
+                if 'max_execution_time' in sql:
+                    raise fhurl.DatabaseError(sql)
+                executed.append(sql.split(' = ')[0])
+
+        class Connection(object):
+            vendor = 'postgresql'
+
+            def cursor(self):
+                return Cursor()
+
+        mysql = Connection()
+        mysql.vendor, mysql.mysql_is_mariadb = 'mysql', False
+        connections = fhurl.connections
+        fhurl.connections = {'default': Connection(), 'mysql': mysql}
+        try:
+            with self.settings(FHURL_DB_TIMEOUTS=True):
+                deadline = fhurl.Deadline(10)
+                for phase in range(3):
+                    with deadline:
+                        pass
+                deadline.arm('mysql')
+                deadline.close()
+        finally:
+            fhurl.connections = connections
+        self.assertEqual(
+            executed, ['SET statement_timeout', 'SET statement_timeout']
+        )
+        self.assertIn('mysql', fhurl._no_timeouts)
+        fhurl._no_timeouts.discard('mysql')
+
+    def test_deadline_timeout_on_first_statement(self):
+        executed = []
+
+        class Cursor(object):
+            def execute(self, sql):
+                executed.append(sql.split(' = ')[0])
+
+        class Connection(object):
+            vendor = 'postgresql'
+
+            def __init__(self):
+                self.execute_wrappers = []
+
+            def cursor(self):
+                return Cursor()
+
+        connection = Connection()
+        connections = fhurl.connections
+        fhurl.connections = {'default': connection}
+        try:
+            deadline = fhurl.Deadline(10)
+            with deadline:
+                pass
+            self.assertEqual(executed, [])  # no statement, no SET
+            wrapper = connection.execute_wrappers[0]
+            wrapper(
+                lambda *args: executed.append('SELECT'), 'SELECT 1', None,
+                False, {}
+            )
+            self.assertEqual(connection.execute_wrappers, [])
+            deadline.close()
+            with fhurl.Deadline(10):
+                pass
+        finally:
+            fhurl.connections = connections
+        self.assertEqual(executed, [
+            'SET statement_timeout', 'SELECT', 'SET statement_timeout'
+        ])
+
+    # process pool
+    def test_pooled(self):
+        del CountingField.calls[:]
+        response = self.client.post('/pooled/', {'number': '4'})
+        data = json.loads(response.content.decode())
+        self.assertTrue(data['success'])
+        self.assertEqual(data['response']['number'], 8)
+        self.assertNotEqual(data['response']['pid'], os.getpid())
+        # field.clean() is not repeated by form.is_valid()
+        self.assertEqual(CountingField.calls, ['4'])
+
+    def test_pooled_errors(self):
+        response = self.client.post('/pooled/', {'number': '3'})
+        data = json.loads(response.content.decode())
+        self.assertFalse(data['success'])
+        self.assertEqual(data['errors'], {'number': ['3 is odd']})
+        response = self.client.post('/pooled/', {'number': 'x'})
+        data = json.loads(response.content.decode())
+        self.assertEqual(data['errors'], {'number': ['Enter a whole number.']})
+
+    def test_pooled_validate_only(self):
+        response = self.client.post(
+            '/pooled/?validate_only=true&field=number', {'number': '3'}
+        )
+        data = json.loads(response.content.decode())
+        self.assertEqual(data, {'valid': False, 'errors': '3 is odd'})
+
+    def test_pooled_inline(self):
+        response = self.client.post('/pooled/inline/', {'number': '4'})
+        data = json.loads(response.content.decode())
+        self.assertEqual(data['response']['number'], 8)
+        self.assertEqual(data['response']['pid'], os.getpid())
+
+    # signed cookie auth
+    def test_signed_cookie_missing(self):
+        response = self.client.post('/signed/')
+        data = json.loads(response.content.decode())
+        self.assertFalse(data['success'])
+        self.assertTrue(data['redirect'].endswith('?next=/signed/'))
+
+    def test_signed_cookie_bad(self):
+        self.client.cookies['fhurl_auth'] = auth.sign(5) + 'x'
+        response = self.client.post('/signed/')
+        data = json.loads(response.content.decode())
+        self.assertIn('redirect', data)
+
+    def test_signed_cookie(self):
+        token = auth.sign(5)
+        self.client.cookies['fhurl_auth'] = token
+        for i in range(2):
+            response = self.client.post('/signed/')
+            data = json.loads(response.content.decode())
+            self.assertTrue(data['success'])
+            self.assertEqual(data['response'], {'id': 5, 'session': False})
+        self.assertIn(token, auth.identities)
+
+    def test_signed_token_header(self):
+        response = self.client.post(
+            '/signed/', HTTP_AUTHORIZATION='Token %s' % auth.sign(7)
+        )
+        data = json.loads(response.content.decode())
+        self.assertEqual(data['response']['id'], 7)
+
+    # access log
+    def post_logged(self, *args, **kw):
+        events = []
+        log = AccessLog(events.extend, max_size=2)
+        set_access_log(log)
+        try:
+            self.client.post(*args, **kw)
+        finally:
+            set_access_log(None)
+        log.flush()
+        return events
+
+    def test_access_log_saved(self):
+        params = {'username': 'john', 'password': 'asd'}
+        event, = self.post_logged('/ajax/only/', params)
+        self.assertEqual(event['route'], '^ajax/only/$')
+        self.assertEqual(event['outcome'], 'saved')
+        self.assertTrue(event['saved'])
+        self.assertEqual(event['status'], 200)
+        self.assertTrue(event['latency'] >= 0)
+
+    def test_access_log_invalid(self):
+        event, = self.post_logged('/named/', {'username': 'john'})
+        self.assertEqual(event['route'], 'named')
+        self.assertEqual(event['outcome'], 'invalid')
+        self.assertEqual(event['errors'], ['password'])
+        self.assertFalse(event['saved'])
+
+    def test_access_log_validate_only(self):
+        event, = self.post_logged(
+            '/named/?validate_only=true&field=username', {'username': 'j'}
+        )
+        self.assertEqual(event['outcome'], 'valid')
+        self.assertEqual(event['errors'], [])
+
+    def test_access_log_timeout(self):
+        event, = self.post_logged('/slow/init/', {})
+        self.assertEqual(event['outcome'], 'timeout')
+        self.assertEqual(event['status'], 504)
+
+    def test_access_log_drops(self):
+        log = AccessLog(lambda events: None, max_size=1)
+        log.emit({})
+        log.emit({})
+        self.assertEqual(log.dropped, 1)
+
+    def test_access_log_sink_fails(self):
+        def sink(events):
+            raise IOError('collector is down')
+
+        log = AccessLog(sink, batch_size=2)
+        for i in range(3):
+            log.queue.put_nowait({})
+        log.run_once()
+        self.assertEqual(log.failed, 2)
+        log.run_once()
+        self.assertEqual(log.failed, 3)
+
+    def test_access_log_file(self):
+        fd, path = tempfile.mkstemp()
+        os.close(fd)
+        try:
+            log = AccessLog(FileSink(path))
+            log.emit({'outcome': 'saved'})
+            log.emit({'outcome': 'invalid'})
+            log.flush()
+            with open(path) as f:
+                lines = [json.loads(line) for line in f]
+        finally:
+            os.remove(path)
+        self.assertEqual(
+            lines, [{'outcome': 'saved'}, {'outcome': 'invalid'}]
+        )
+
+    # metrics
+    def test_metrics(self):
+        metrics = Metrics()
+        set_metrics(metrics)
+        try:
+            self.client.post('/named/', {'username': 'john'})
+            self.client.post('/named/', {'username': 'john', 'password': 'x'})
+            with self.settings(FHURL_METRICS_ALLOWED_IPS=['127.0.0.1']):
+                response = self.client.get('/metrics/')
+        finally:
+            set_metrics(None)
+        self.assertEqual(response.status_code, 200)
+        lines = response.content.decode().splitlines()
+        for line in [
+            '# TYPE fhurl_requests_total counter',
+            'fhurl_requests_total{route="named",outcome="invalid"} 1',
+            'fhurl_requests_total{route="named",outcome="saved"} 1',
+            'fhurl_validation_failures_total{route="named",field="password"}'
+            ' 1',
+            '# TYPE fhurl_latency_seconds histogram',
+            'fhurl_latency_seconds_bucket{route="named",le="+Inf"} 2',
+            'fhurl_latency_seconds_count{route="named"} 2',
+            'fhurl_response_bytes_bucket{route="named",le="10000"} 2',
+        ]:
+            self.assertIn(line, lines)
+
+    def test_metrics_form_handler_view(self):
+        metrics = Metrics()
+        set_metrics(metrics)
+        try:
+            self.client.post('/direct/', {'username': 'john'})
+            self.client.post('/named/', {'username': 'john'})
+            with self.settings(FHURL_METRICS_ALLOWED_IPS=['127.0.0.1']):
+                response = self.client.get('/metrics/')
+        finally:
+            set_metrics(None)
+        self.assertEqual(response.status_code, 200)
+        self.assertIn(
+            'fhurl_requests_total{route="fhurl_t.urls.AjaxOnly",'
+            'outcome="invalid"} 1', response.content.decode().splitlines()
+        )
+
+    def test_metrics_pid_reused(self):
+        directory = tempfile.mkdtemp()
+        event = {
+            'route': '^a$', 'outcome': 'saved', 'errors': [], 'saved': True,
+            'latency': 0.1,
+        }
+        try:
+            for i in range(2):
+                # a worker dies, and next one gets the same pid
+                metrics = Metrics(directory)
+                metrics.record(event)
+                metrics.flush()
+                time.sleep(0.002)
+            self.assertEqual(len(os.listdir(directory)), 2)
+            text = metrics.exposition()
+        finally:
+            metrics.directory = None
+            shutil.rmtree(directory)
+        self.assertIn(
+            'fhurl_requests_total{route="^a$",outcome="saved"} 2', text
+        )
+
+    def test_metrics_not_local(self):
+        set_metrics(Metrics())
+        try:
+            response = self.client.get('/metrics/', REMOTE_ADDR='10.0.0.1')
+        finally:
+            set_metrics(None)
+        self.assertEqual(response.status_code, 403)
+
+    def test_metrics_default_denied(self):
+        set_metrics(Metrics())
+        try:
+            response = self.client.get('/metrics/')
+        finally:
+            set_metrics(None)
+        self.assertEqual(response.status_code, 403)
+
+    def test_metrics_merge_exited(self):
+        directory = tempfile.mkdtemp()
+        process = subprocess.Popen([sys.executable, '-c', ''])
+        process.wait()
+        try:
+            other = Metrics()
+            other.record({
+                'route': '^a$', 'outcome': 'error', 'errors': [],
+                'saved': True, 'latency': 0.2,
+            })
+            name = 'fhurl-%d-1.json' % process.pid
+            with open(os.path.join(directory, name), 'w') as f:
+                json.dump(other.snapshot(), f)
+            metrics = Metrics(directory)
+            metrics.exposition()
+            text = metrics.exposition()
+            names = sorted(os.listdir(directory))
+        finally:
+            metrics.directory = None
+            shutil.rmtree(directory)
+        self.assertIn('fhurl_save_exceptions_total{route="^a$"} 1', text)
+        self.assertNotIn(name, names)
+        self.assertIn('fhurl-totals.json', names)
+
+    def test_metrics_directory(self):
+        directory = tempfile.mkdtemp()
+        try:
+            other = Metrics()
+            other.record({
+                'route': '^a$', 'outcome': 'error', 'errors': [],
+                'saved': True, 'latency': 0.2,
+            })
+            with open(os.path.join(directory, 'fhurl-1.json'), 'w') as f:
+                json.dump(other.snapshot(), f)
+            metrics = Metrics(directory)
+            metrics.record({
+                'route': '^a$', 'outcome': 'error', 'errors': [],
+                'saved': True, 'latency': 3,
+            })
+            text = metrics.exposition()
+        finally:
+            metrics.directory = None
+            shutil.rmtree(directory)
+        self.assertIn('fhurl_save_exceptions_total{route="^a$"} 2', text)
+        self.assertIn('fhurl_latency_seconds_bucket{route="^a$",le="0.25"} 1',
+                      text)
+        self.assertIn('fhurl_latency_seconds_sum{route="^a$"} 3.2', text)
+
+    # translation cache
+    def test_render_errors_cached(self):
+        fhurl._texts.clear()
+        form = ConstrainedForm(None, data={'email': 'x', 'age': '5'})
+        form.is_valid()
+        errors = render_errors(form.errors)
+        self.assertEqual(errors['even'], ['This field is required.'])
+        self.assertEqual(
+            errors['age'],
+            ['Ensure this value is greater than or equal to 18.']
+        )
+        count = len(fhurl._texts)
+        self.assertEqual(render_errors(form.errors), errors)
+        self.assertEqual(len(fhurl._texts), count)
+        with translation.override('de'):
+            self.assertEqual(
+                render_errors(form.errors)['even'],
+                ['Dieses Feld ist zwingend erforderlich.']
+            )
+        self.assertTrue(len(fhurl._texts) > count)
+
+    def test_render_errors_params(self):
+        params = {'username': 'x' * 200, 'password': 'x'}
+        response = self.client.post('/ajax/only/', params)
+        data = json.loads(response.content.decode())
+        self.assertEqual(
+            data['errors']['username'],
+            ['Ensure this value has at most 100 characters (it has 200).']
+        )
+        response = self.client.post(
+            '/login/with/?validate_only=true&field=username', params
+        )
+        data = json.loads(response.content.decode())
+        self.assertFalse(data['valid'])
+        self.assertEqual(
+            data['errors'],
+            'Ensure this value has at most 100 characters (it has 200).'
+        )
+
+    def test_precompute_texts(self):
+        fhurl._texts.clear()
+        precompute_texts([settings.LANGUAGE_CODE, 'de'])
+        languages = set(key[0] for key in fhurl._texts)
+        self.assertEqual(languages, set([settings.LANGUAGE_CODE, 'de']))
+        count = len(fhurl._texts)
+        self.client.get('/login/with/?json=true')
+        self.client.post('/login/with/?json=true')
+        self.assertEqual(len(fhurl._texts), count)
+        fhurl._texts.clear()
+        precompute_texts()
+        languages = set(key[0] for key in fhurl._texts)
+        self.assertEqual(languages, set([settings.LANGUAGE_CODE]))
+
+    # upload policies
+    def upload(self, url, name, content, content_type='text/plain'):
+        doc = SimpleUploadedFile(name, content, content_type)
+        response = self.client.post(url, {'doc': doc})
+        return json.loads(response.content.decode())
+
+    def test_upload(self):
+        data = self.upload('/upload/', 'a.txt', b'hello')
+        self.assertTrue(data['success'])
+        self.assertEqual(data['response']['content'], 'hello')
+
+    def test_upload_too_large(self):
+        data = self.upload('/upload/', 'a.txt', b'hello world')
+        self.assertFalse(data['success'])
+        self.assertEqual(
+            data['errors'], {'doc': ['File is larger than 10 bytes.']}
+        )
+
+    def test_upload_content_type(self):
+        data = self.upload('/upload/', 'a.png', b'hello', 'image/png')
+        self.assertEqual(
+            data['errors'], {'doc': ['File type image/png is not allowed.']}
+        )
+
+    def test_upload_validate_only(self):
+        doc = SimpleUploadedFile('a.txt', b'hello world', 'text/plain')
+        response = self.client.post(
+            '/upload/?validate_only=true&field=doc', {'doc': doc}
+        )
+        data = json.loads(response.content.decode())
+        self.assertEqual(
+            data, {'valid': False, 'errors': 'File is larger than 10 bytes.'}
+        )
+
+    def test_upload_stream(self):
+        data = self.upload('/upload/stream/', 'a.txt', b'hello world')
+        self.assertTrue(data['success'])
+        self.assertEqual(data['response']['class'], 'TemporaryUploadedFile')
+        self.assertEqual(data['response']['content'], 'hello world')
+
+    def test_upload_post_already_read(self):
+        self.assertRaises(
+            ImproperlyConfigured, self.upload, '/upload/read/', 'a.txt',
+            b'hello'
+        )
+
+    # admission control
+    def test_rate_limit(self):
+        for i in range(2):
+            response = self.client.get('/rate/limited/')
+            self.assertEqual(response.status_code, 200)
+        response = self.client.get('/rate/limited/')
+        self.assertEqual(response.status_code, 429)
+        self.assertTrue(0 < int(response['Retry-After']) <= 30)
+        data = json.loads(response.content.decode())
+        self.assertEqual(data, {'success': False, 'throttled': True})
+
+    def test_limiter_concurrency(self):
+        limiter = Limiter(max_concurrency=1, key='ip')
+        request = self.client.get('/ajax/only/').wsgi_request
+        key = limiter.enter(request)
+        with self.assertRaises(Throttled) as cm:
+            limiter.enter(request)
+        self.assertEqual(cm.exception.status, 503)
+        limiter.exit(key)
+        limiter.exit(limiter.enter(request))
+        self.assertEqual(
+            limiter.stats(), {
+                'admitted': 2, 'rejected_concurrency': 1,
+                'rejected_rate': 0, 'active': 0,
+            }
+        )
+
+    def test_limiter_queue_timeout(self):
+        limiter = Limiter(max_concurrency=1, queue_timeout=5)
+        request = self.client.get('/ajax/only/').wsgi_request
+        key = limiter.enter(request)
+        timer = threading.Timer(0.05, limiter.exit, [key])
+        timer.start()
+        limiter.exit(limiter.enter(request))
+        timer.join()
+        self.assertEqual(limiter.stats()['admitted'], 2)
+
+    def test_limiter_backend(self):
+        limiter = Limiter(
+            max_concurrency=1, rate='2/h', backend='default', name='t'
+        )
+        other = Limiter(
+            max_concurrency=1, rate='2/h', backend='default', name='t'
+        )
+        request = self.client.get('/ajax/only/').wsgi_request
+        key = limiter.enter(request)
+        with self.assertRaises(Throttled) as cm:
+            other.enter(request)
+        self.assertEqual(cm.exception.status, 503)
+        limiter.exit(key)
+        with self.assertRaises(Throttled) as cm:
+            other.enter(request)
+        self.assertEqual(cm.exception.status, 429)
+
+    def test_limiter_queue_wakes_same_key(self):
+        limiter = Limiter(max_concurrency=1, queue_timeout=5, key='ip')
+        a = self.client.get('/ajax/only/', REMOTE_ADDR='10.0.0.1')
+        b = self.client.get('/ajax/only/', REMOTE_ADDR='10.0.0.2')
+        slot_a = limiter.enter(a.wsgi_request)
+        slot_b = limiter.enter(b.wsgi_request)
+        admitted = []
+
+        def wait(request):
+            slot = limiter.enter(request)
+            admitted.append(time.time())
+            limiter.exit(slot)
+        threads = [
+            threading.Thread(target=wait, args=[r.wsgi_request])
+            for r in (b, a)
+        ]
+        for thread in threads:
+            thread.start()
+        time.sleep(0.05)
+        released = time.time()
+        limiter.exit(slot_a)
+        threads[1].join(1)
+        self.assertFalse(threads[1].is_alive())
+        self.assertEqual(len(admitted), 1)
+        self.assertTrue(admitted[0] - released < 0.5)
+        limiter.exit(slot_b)
+        threads[0].join(1)
+        self.assertEqual(limiter.stats()['admitted'], 4)
+
+    def test_limiter_prunes_buckets(self):
+        limiter = Limiter(rate='10/s', key='ip')
+        limiter.buckets = dict(
+            ('ip:%d' % i, (0, 100.0)) for i in range(1500)
+        )
+        limiter.buckets['ip:busy'] = (0, 100.5)
+        limiter.prune(100.5)
+        self.assertEqual(len(limiter.buckets), 1501)
+        limiter.prune(101.0)
+        self.assertEqual(list(limiter.buckets), ['ip:busy'])
+        self.assertEqual(limiter.prune_at, 1000)
+
+    def test_limiter_backend_slot_expires(self):
+        from django.core.cache import cache
+        limiter = Limiter(
+            max_concurrency=1, backend='default', name='ttl', slot_ttl=0.05
+        )
+        request = self.client.get('/ajax/only/').wsgi_request
+        limiter.enter(request)  # worker crashes, never exits
+        with self.assertRaises(Throttled):
+            limiter.enter(request)
+        time.sleep(0.1)
+        slot = limiter.enter(request)
+        cache.delete(slot)  # evicted
+        limiter.exit(slot)
+
+    def test_limiter_backend_slots_expire_separately(self):
+        limiter = Limiter(
+            max_concurrency=2, backend='default', name='slots', slot_ttl=0.2
+        )
+        request = self.client.get('/ajax/only/').wsgi_request
+        limiter.enter(request)
+        time.sleep(0.1)
+        limiter.enter(request)
+        time.sleep(0.15)
+        # only the first slot expired
+        limiter.enter(request)
+        with self.assertRaises(Throttled):
+            limiter.enter(request)
+
+    # prefork
+    def test_preload(self):
+        from django.core.urlresolvers import resolve
+        fhurl.reset_manifest()
+        fhurl._texts.clear()
+        from django.core.urlresolvers import get_resolver
+        resolver = get_resolver(None)
+        resolver._reverse_dict.clear()
+        preload([settings.LANGUAGE_CODE], freeze=False)
+        self.assertIn(translation.get_language(), resolver._reverse_dict)
+        self.assertIs(resolve('/dotted/').kwargs['form_cls'], AjaxOnly)
+        self.assertIn('^dotted/$', fhurl.get_manifest()['forms'])
+        self.assertTrue(fhurl._texts)
+        response = self.client.post('/dotted/')
+        data = json.loads(response.content.decode())
+        self.assertIn('username', data['errors'])
+
+
+class TestReplicas(TestCase):
+    multi_db = True
+
+    def setUp(self):
+        Book.objects.using('default').create(pk=1, title='primary')
+        Book.objects.using('replica').create(pk=1, title='replica')
+
+    def _ajax(self, method, url, data=None):
+        response = getattr(self.client, method)(
+            url, data or {}, HTTP_X_REQUESTED_WITH='XMLHttpRequest'
+        )
+        return json.loads(response.content.decode())
+
+    def test_replica_schema(self):
+        data = self._ajax('get', '/replica/')
+        self.assertEqual(data['title']['initial'], 'replica')
+        data = self._ajax('get', '/replica/off/')
+        self.assertEqual(data['title']['initial'], 'primary')
+        self.assertIsNone(fhurl.get_phase())
+
+    def test_replica_validation(self):
+        data = self._ajax('post', '/replica/?validate_only=true')
+        self.assertTrue(data['valid'])
+        data = self._ajax('post', '/replica/off/?validate_only=true')
+        self.assertFalse(data['valid'])
+
+    def test_replica_save(self):
+        data = self._ajax('post', '/replica/', {'title': 'new'})
+        self.assertTrue(data['success'])
+        self.assertEqual(data['response'], 'primary')
+        self.assertEqual(
+            Book.objects.using('default').filter(title='new').count(), 1
+        )
+        self.assertEqual(
+            Book.objects.using('replica').filter(title='new').count(), 0
+        )
+
+    def test_replica_deadline(self):
+        armed = []
+
+        class Connection(object):
+            vendor = 'sqlite'
+
+            def __init__(self, alias):
+                self.alias = alias
+
+        def timeout_sql(connection, ms):
+            armed.append(connection.alias)
+            return None, None
+
+        connections, sql = fhurl.connections, fhurl._timeout_sql
+        fhurl.connections = dict(
+            (alias, Connection(alias)) for alias in ('default', 'replica')
+        )
+        fhurl._timeout_sql = timeout_sql
+        try:
+            fhurl._set_phase('validation')
+            with self.settings(FHURL_DB_TIMEOUTS=True):
+                with fhurl.Deadline(10):
+                    pass
+        finally:
+            fhurl._set_phase(None)
+            fhurl.connections, fhurl._timeout_sql = connections, sql
+        self.assertEqual(armed, ['default', 'replica'])
@@ -1,7 +1,13 @@
+import os
+import time
 from django.conf.urls.defaults import *
 from django.http import HttpResponse, Http404
 from django import forms
-from fhurl import fhurl, RequestForm
+from django.utils.translation import gettext_lazy as _
+from fhurl import fhurl, fhurl_formset, fhurl_ingest, RequestForm
+from fhurl import form_handler, manifest_handler, metrics_handler, pooled, SignedCookieAuth
+from fhurl import UploadPolicy, ValidationCache
+from fhurl_t.models import Book
 
 class LoginFormWithoutRequest(forms.Form):
     username = forms.CharField(max_length=100, label="Username")
@@ -35,6 +41,13 @@ class InitRaising404(LoginFormWithRequest):
 def custom_requirement(request):
     return request.REQUEST.get("foo") != "bar"
 
+def read_post(view):
+    # like a middleware reading request.POST before fhurl does
+    def wrapper(request, *args, **kw):
+        request.POST
+        return view(request, *args, **kw)
+    return wrapper
+
 class AjaxOnly(LoginFormWithRequest):
     def save(self):
         return self.cleaned_data
@@ -45,6 +58,146 @@ class BothAjaxAndWeb(LoginFormWithRequest):
     def save(self):
         return HttpResponse("hi %s" % self.cleaned_data["username"])
 
+class EvenField(forms.IntegerField):
+    def get_constraints(self):
+        return {"multiple_of": 2}
+
+class ConstrainedForm(RequestForm):
+    email = forms.EmailField()
+    age = forms.IntegerField(min_value=18, max_value=99)
+    code = forms.RegexField(regex=r"^[A-Z]{3}$", min_length=3)
+    color = forms.ChoiceField(choices=(("r", "Red"), ("g", "Green")))
+    price = forms.DecimalField(max_digits=5, decimal_places=2, max_value=100)
+    even = EvenField()
+    slug = forms.SlugField()
+    shade = forms.ChoiceField(choices=(("d", _("Dark")), ("l", _("Light"))))
+    word = forms.RegexField(regex=r"^(?P<word>\w+)$")
+
+class UsernameForm(RequestForm):
+    username = forms.CharField(max_length=100)
+    taken = set(["amitu"])
+    checks = []
+
+    def clean_username(self):
+        username = self.cleaned_data["username"]
+        self.checks.append(username)
+        if username in self.taken:
+            raise forms.ValidationError("This username is already taken.")
+        return username
+
+    def save(self):
+        self.taken.add(self.cleaned_data["username"])
+        self.invalidate_validations("username", self.cleaned_data["username"])
+        return self.cleaned_data["username"]
+
+class MeForm(RequestForm):
+    username = forms.CharField()
+
+    def clean_username(self):
+        if self.cleaned_data["username"] != self.request.GET.get("me"):
+            raise forms.ValidationError("Not you.")
+        return self.cleaned_data["username"]
+
+class BookForm(RequestForm):
+    title = forms.CharField(max_length=50)
+
+    @classmethod
+    def save_all(cls, forms):
+        return Book.objects.bulk_create(
+            [Book(title=form.cleaned_data["title"]) for form in forms]
+        )
+
+    def get_json(self, saved):
+        return saved.title
+
+class PickyBookForm(BookForm):
+    def init(self):
+        if self.data.get("title") == "stop":
+            return HttpResponse(status=403)
+
+    @classmethod
+    def save_all(cls, forms):
+        titles = [form.cleaned_data["title"] for form in forms]
+        if "boom" in titles:
+            raise ValueError("boom")
+        results = super(PickyBookForm, cls).save_all(forms)
+        if "short" in titles:
+            return results[:-1]
+        return results
+
+class SlowInit(AjaxOnly):
+    def init(self):
+        time.sleep(0.05)
+
+class DeadlineAware(AjaxOnly):
+    def save(self):
+        return self.deadline.remaining()
+
+def double_even(value):
+    if value % 2:
+        raise forms.ValidationError("%s is odd" % value)
+    return value * 2
+
+def get_pid(value):
+    return os.getpid()
+
+class CountingField(forms.IntegerField):
+    calls = []
+
+    def to_python(self, value):
+        self.calls.append(value)
+        return super(CountingField, self).to_python(value)
+
+class PooledForm(RequestForm):
+    number = CountingField()
+    pid = forms.CharField(required=False)
+
+    clean_number = pooled(double_even)
+    clean_pid = pooled(get_pid)
+
+    def save(self):
+        return self.cleaned_data
+
+class IdentityForm(RequestForm):
+    def save(self):
+        return {
+            "id": self.request.fhurl_identity,
+            "session": self.request.session.accessed,
+        }
+
+auth = SignedCookieAuth()
+
+class UploadForm(RequestForm):
+    doc = forms.FileField()
+
+    def save(self):
+        doc = self.cleaned_data["doc"]
+        return {
+            "class": doc.__class__.__name__,
+            "content": b"".join(doc.chunks()).decode(),
+        }
+
+class UserForm(RequestForm):
+    def __init__(self, request, *args, **kw):
+        super(UserForm, self).__init__(request, *args, **kw)
+        self.user = request.user
+
+class ReplicaForm(RequestForm):
+    title = forms.CharField(required=False)
+
+    def init(self):
+        self.initial["title"] = Book.objects.get(pk=1).title
+
+    def clean_title(self):
+        if Book.objects.get(pk=1).title != "replica":
+            raise forms.ValidationError("primary")
+        return self.cleaned_data["title"]
+
+    def save(self):
+        Book.objects.create(title=self.cleaned_data["title"])
+        return Book.objects.get(pk=1).title
+
+
 urlpatterns = patterns('',
     fhurl(
         "^login/without/$", LoginFormWithoutRequest, template="login.html",
@@ -80,4 +233,44 @@ urlpatterns = patterns('',
     ),
     fhurl("^ajax/only/$", AjaxOnly, ajax=True),
     fhurl("^both/ajax/and/web/$", BothAjaxAndWeb, template="login.html"),
+    fhurl("^named/$", AjaxOnly, ajax=True, name="named"),
+    url("^manifest/$", manifest_handler),
+    url("^metrics/$", metrics_handler),
+    url("^direct/$", form_handler, {"form_cls": AjaxOnly, "ajax": True}),
+    fhurl("^constraints/$", ConstrainedForm, ajax=True),
+    fhurl("^cached/validation/$", UsernameForm, ajax=True,
+          validation_cache=True),
+    fhurl_ingest("^books/import/picky/$", PickyBookForm, chunk_size=2),
+    fhurl_ingest("^books/import/custom/$", BookForm,
+                 require_login=custom_requirement),
+    fhurl("^cached/me/$", MeForm, ajax=True, validation_cache=True),
+    fhurl("^cached/shared/$", UsernameForm, ajax=True,
+          validation_cache=ValidationCache(key=lambda request: None)),
+    fhurl_formset("^books/$", BookForm, max_num=3),
+    fhurl_formset("^users/$", UsernameForm),
+    fhurl("^slow/init/$", SlowInit, ajax=True, timeout=0.01),
+    fhurl("^deadline/$", DeadlineAware, ajax=True, timeout=10),
+    fhurl("^pooled/$", PooledForm, ajax=True),
+    fhurl("^pooled/inline/$", PooledForm, ajax=True, pool=False),
+    fhurl("^signed/$", IdentityForm, ajax=True, require_login=auth),
+    fhurl(
+        "^upload/$", UploadForm, ajax=True, uploads={
+            "doc": UploadPolicy(max_size=10, content_types=["text/plain"])
+        }
+    ),
+    fhurl(
+        "^upload/stream/$", UploadForm, ajax=True,
+        uploads={"*": UploadPolicy(stream=True)}
+    ),
+    fhurl(
+        "^upload/read/$", UploadForm, ajax=True, decorator=read_post,
+        uploads={"*": UploadPolicy(max_size=10)}
+    ),
+    fhurl("^rate/limited/$", AjaxOnly, ajax=True, rate="2/m"),
+    fhurl("^dotted/$", "fhurl_t.urls.AjaxOnly", ajax=True),
+    fhurl_ingest("^books/import/$", BookForm, chunk_size=2,
+                 max_line_size=100),
+    fhurl("^user/$", UserForm, ajax=True),
+    fhurl("^replica/$", ReplicaForm, ajax=True),
+    fhurl("^replica/off/$", ReplicaForm, ajax=True, replicas=False),
 )
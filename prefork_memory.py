@@ -0,0 +1,117 @@
+"""
+Measures unique memory of prefork workers, with and without fhurl.preload()
+in the master process.
+
+    $ python prefork_memory.py [workers]
+
+Uses the bundled example project (fhurl_t), set DJANGO_SETTINGS_MODULE to
+measure another one. Linux only, as it reads /proc/<pid>/smaps.
+"""
+import os
+import sys
+import gc
+import subprocess
+
+os.environ.setdefault("DJANGO_SETTINGS_MODULE", "fhurl_t.settings")
+
+
+def unique_memory():
+    # memory not shared with any other process, in kB
+    path = "/proc/self/smaps_rollup"
+    if not os.path.exists(path):
+        path = "/proc/self/smaps"
+    total = 0
+    with open(path) as f:
+        for line in f:
+            if line.startswith(("Private_Clean:", "Private_Dirty:")):
+                total += int(line.split()[1])
+    return total
+
+
+def serve():
+    # what a worker does while serving: resolve every fhurl route, and GET
+    # its schema
+    from django.test import RequestFactory
+    from django.contrib.auth.models import AnonymousUser
+    try:
+        from django.urls import get_resolver, resolve
+    except ImportError:
+        from django.core.urlresolvers import get_resolver, resolve
+    factory = RequestFactory()
+    for pattern in get_resolver(None).url_patterns:
+        regex = getattr(pattern, "regex", None)
+        if regex is None:  # django 2+
+            regex = pattern.pattern.regex
+        if "form_cls" not in pattern.default_args or "(" in regex.pattern:
+            continue  # not fhurl, or needs url parameters
+        path = "/" + regex.pattern.strip("^$")
+        request = factory.get(path, HTTP_X_REQUESTED_WITH="XMLHttpRequest")
+        request.user = AnonymousUser()
+        try:
+            match = resolve(path)
+            match.func(request, *match.args, **match.kwargs)
+        except Exception:
+            pass  # eg route needing a database, it is still loaded
+    gc.collect()
+
+
+def run_master(workers, preload):
+    import django
+    if hasattr(django, "setup"):
+        django.setup()
+    import fhurl
+    if preload:
+        fhurl.preload()
+    results_r, results_w = os.pipe()
+    release_r, release_w = os.pipe()
+    pids = []
+    for i in range(workers):
+        pid = os.fork()
+        if pid == 0:
+            os.close(results_r)
+            os.close(release_w)
+            serve()
+            os.write(results_w, ("%d\n" % unique_memory()).encode())
+            # stay alive till all workers are measured, so pages shared
+            # between workers are not counted as unique
+            os.read(release_r, 1)
+            os._exit(0)
+        pids.append(pid)
+    os.close(results_w)
+    os.close(release_r)
+    with os.fdopen(results_r) as f:
+        sizes = [int(f.readline()) for pid in pids]
+    os.close(release_w)
+    for pid in pids:
+        os.waitpid(pid, 0)
+    print(" ".join(str(size) for size in sizes))
+
+
+def measure(workers, preload):
+    # every mode runs in a fresh interpreter, so they start from same state
+    output = subprocess.check_output([
+        sys.executable, __file__, str(workers),
+        "--master", "preload" if preload else "lazy",
+    ])
+    return [int(size) for size in output.split()]
+
+
+def main():
+    workers = int(sys.argv[1]) if len(sys.argv) > 1 else 4
+    if "--master" in sys.argv:
+        mode = sys.argv[sys.argv.index("--master") + 1]
+        run_master(workers, mode == "preload")
+        return
+    for preload in (False, True):
+        sizes = measure(workers, preload)
+        print(
+            "%-8s workers: %d, unique memory per worker: %d kB (total %d kB)"
+            % (
+                "preload" if preload else "lazy", workers,
+                sum(sizes) // len(sizes), sum(sizes)
+            )
+        )
+
+
+if __name__ == "__main__":
+    main()
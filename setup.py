@@ -9,5 +9,5 @@ setup(
     author = 'Amit Upadhyay',
     author_email = "upadhyay@gmail.com",
     install_requires = ["smarturls"],
-    py_modules = ["fhurl"],
+    py_modules = ["fhurl", "fhurl_router"],
 )